@@ -0,0 +1,81 @@
+"""Time the database operations done by the sql workers for each job.
+
+Usage: python sqlbench.py [-n N] [-j JOBS] [<tablepath>]
+
+Inserts JOBS jobs of 30 keys in the table (by default, a new sqlite
+database in a temporary directory) and prints the time taken by each
+operation, averaged over N runs:
+
+ - book+release: book a job with `sql.book_many` and put it back,
+ - status x2: the two status changes made around each `save` of the
+   channel,
+ - save 5 keys: write 5 changed keys, as `DBRSyncChannel.save` does,
+ - heartbeat: refresh the heartbeat of the job.
+
+Use a table made for the occasion: the jobs are left in it.
+"""
+import sys
+import os
+import time
+import shutil
+import tempfile
+
+import getopt
+
+if __name__ == '__main__':
+
+    opts, args = getopt.getopt(sys.argv[1:], 'n:j:h', ['help'])
+    opts = dict(opts)
+    if '-h' in opts or '--help' in opts or len(args) > 1:
+        print __doc__
+        sys.exit(0)
+    n = int(opts.get('-n', 300))
+    n_jobs = int(opts.get('-j', 2000))
+
+    from jobman import api0, sql
+
+    tmpdir = None
+    if args:
+        dbstr = args[0]
+    else:
+        tmpdir = tempfile.mkdtemp()
+        dbstr = 'sqlite:///%s?table=bench' % os.path.join(tmpdir, 'bench.db')
+
+    try:
+        db = api0.open_db(dbstr, serial=True, pooled=True)
+        sql.insert_dicts([dict(('k%i' % j, i * j) for j in range(30))
+                          for i in range(n_jobs)], db, force_dup=True)
+
+        def bench(name, fn):
+            fn()
+            t0 = time.time()
+            for i in xrange(n):
+                fn()
+            print '%-15s %8.3f ms' % (name, (time.time() - t0) / n * 1000)
+
+        def book():
+            sql.release_dcts(db, sql.book_many(db, 1, verbose=0))
+        bench('book+release', book)
+
+        dct = sql.book_many(db, 1, verbose=0)[0]
+        session = db.session()
+
+        def status():
+            dct.update_in_session({'jobman.status': sql.ERR_SYNC}, session)
+            dct.update_in_session({'jobman.status': sql.RUNNING}, session)
+        bench('status x2', status)
+
+        count = [0]
+
+        def save():
+            count[0] += 1
+            dct.update_in_session(dict(('k%i' % j, count[0])
+                                       for j in range(5)), session)
+        bench('save 5 keys', save)
+
+        bench('heartbeat', lambda: db.heartbeat([dct.id]))
+        session.close()
+        sql.release_dcts(db, [dct])
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
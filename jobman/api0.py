@@ -23,14 +23,25 @@ if sql.sqlalchemy_ok:
 
     from sqlalchemy.orm import sessionmaker
     from sqlalchemy.orm import mapper, relation, eagerload  # backref
+    from sqlalchemy.orm import aliased
+    from sqlalchemy.orm.collections import attribute_mapped_collection
 
-    #from sqlalchemy.engine.base import Connection
+    from sqlalchemy.engine.base import Connection
 
     from sqlalchemy.sql import select  # operators
     # outerjoin
     from sqlalchemy.sql.expression import column, not_, literal_column
+    from sqlalchemy.sql.expression import literal, cast
+    from sqlalchemy.types import TypeDecorator, UserDefinedType
+    from sqlalchemy.orm.attributes import instance_state, set_committed_value
+    from sqlalchemy.orm.session import object_session
+    from sqlalchemy.sql.expression import bindparam
 
     from sqlalchemy.engine.url import make_url
+    from sqlalchemy import event
+    from sqlalchemy.exc import DisconnectionError
+    from sqlalchemy.engine.reflection import Inspector
+    from sqlalchemy.schema import CreateIndex
 
 else:
     from jobman import fake_sqlalchemy as sqlalchemy
@@ -38,6 +49,18 @@ else:
 import time
 import random
 import os
+import sys
+import contextlib
+import datetime
+import ast
+import struct
+import base64
+import zlib
+import select as select_module
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 
 class Todo(Exception):
@@ -47,6 +70,334 @@ class Todo(Exception):
     """Replace this with some working code!"""
 
 
+def _encode_val(val):
+    """Return the keyval columns used to store `val`.
+
+    This is the type conversion heuristic of `KeyVal`, as a dictionary
+    with keys 'type', 'ival', 'fval', 'sval' and 'bval'.
+    """
+    row = dict(type=None, ival=None, fval=None, sval=None, bval=None)
+    if isinstance(val, (str, unicode)):
+        row['type'] = 's'
+        row['sval'] = val
+    elif isinstance(val, float):
+        row['type'] = 'f'
+        # special cases
+        if str(val) in ('nan', 'inf', '-inf'):
+            # Special cases not handled by SQLAlchemy.
+            # To avoid crashes, setting value to None
+            row['fval'] = None
+        else:
+            row['fval'] = float(val)
+    elif isinstance(val, int):
+        row['type'] = 'i'
+        row['ival'] = int(val)
+    else:
+        row['type'] = 'b'
+        row['bval'] = _encode_bval(val)
+    return row
+
+
+def _decode_val(type, ival, fval, sval, bval, _trees=None):
+    """Return the value stored in the keyval columns, see `_encode_val`."""
+    if type == 'i':
+        return int(ival)
+    elif type == 'f':
+        if fval is None:
+            return float('nan')
+        return float(fval)
+    elif type == 'b':
+        return _decode_bval(bval, _trees)
+    elif type == 's':
+        return sval
+    raise ValueError('Incompatible value in column "type"', type)
+
+
+def _decode_vals(rows):
+    """Return the values of a batch of (type, ival, fval, sval, bval) rows.
+
+    The parsing of the literals is shared by the rows of the batch that
+    hold the same value.
+    """
+    trees = {}
+    return [_decode_val(*(tuple(row) + (trees,))) for row in rows]
+
+# The bval column holds a NUL byte, a tag character and then:
+#  'A': a numpy array or scalar, as dtype, shape and raw buffer
+#  'd', 'q': a list ('l') or tuple ('t') of floats or ints, as a
+#            float64 or int64 buffer
+#  'L': the repr of a python literal, read back with ast.literal_eval
+#  'S': a set ('s') or frozenset ('f'), as the 'L' encoding of a list
+# Values stored by older versions of jobman are an untagged repr, only
+# read back.
+_BVAL_TAG = '\x00'
+
+
+def _encode_bval(val):
+    """Return the content of the bval column used to store `val`.
+
+    @raise TypeError: if `val` is neither numeric nor a python literal
+    """
+    numpy = sys.modules.get('numpy')
+    if numpy is not None and isinstance(val, (numpy.ndarray, numpy.generic)):
+        arr = numpy.asarray(val)
+        if arr.dtype.kind in 'biufc':
+            dtype = arr.dtype.str
+            return ''.join([_BVAL_TAG, 'A',
+                            struct.pack('<BB', len(dtype), arr.ndim), dtype,
+                            struct.pack('<%dq' % arr.ndim, *arr.shape),
+                            arr.tostring()])
+    if type(val) in (list, tuple) and val:
+        kind = type(val) is list and 'l' or 't'
+        if all(type(v) is float for v in val):
+            return ''.join([_BVAL_TAG, 'd', kind,
+                            struct.pack('<%dd' % len(val), *val)])
+        if all(type(v) is int for v in val):
+            return ''.join([_BVAL_TAG, 'q', kind,
+                            struct.pack('<%dq' % len(val), *val)])
+    if type(val) in (set, frozenset):
+        kind = type(val) is set and 's' or 'f'
+        try:
+            # the same set always gives the same bval, see filter_eq
+            items = sorted(val)
+        except TypeError:
+            items = list(val)
+        return ''.join([_BVAL_TAG, 'S', kind, _literal_repr(items)])
+    return _BVAL_TAG + 'L' + _literal_repr(val)
+
+
+def _literal_repr(val):
+    text = repr(val)
+    try:
+        is_literal = bool(ast.literal_eval(text) == val)
+    except Exception:
+        is_literal = False
+    if not is_literal:
+        raise TypeError('can not store %s: only numbers, numpy arrays and'
+                        ' python literals are supported' % text)
+    return text
+
+
+def _literal_eval(text, trees):
+    if trees is None:
+        return ast.literal_eval(text)
+    try:
+        tree = trees[text]
+    except KeyError:
+        tree = trees[text] = ast.parse(text, mode='eval')
+    return ast.literal_eval(tree)
+
+
+def _decode_bval(bval, _trees=None):
+    """Return the value stored in the bval column, see `_encode_bval`."""
+    data = str(bval)
+    if not data.startswith(_BVAL_TAG):
+        # untagged repr, only written by older versions of jobman: eval is
+        # kept for the rows whose repr is not a literal
+        try:
+            return _literal_eval(data, _trees)
+        except (ValueError, SyntaxError):
+            return eval(data)
+    tag = data[1]
+    if tag == 'L':
+        return _literal_eval(data[2:], _trees)
+    elif tag == 'S':
+        vals = _literal_eval(data[3:], _trees)
+        if data[2] == 's':
+            return set(vals)
+        return frozenset(vals)
+    elif tag in ('d', 'q'):
+        vals = struct.unpack('<%d%s' % ((len(data) - 3) // 8, tag), data[3:])
+        if data[2] == 'l':
+            return list(vals)
+        return vals
+    elif tag == 'A':
+        import numpy
+        len_dtype, ndim = struct.unpack('<BB', data[2:4])
+        pos = 4 + len_dtype
+        dtype = data[4:pos]
+        shape = struct.unpack('<%dq' % ndim, data[pos:pos + 8 * ndim])
+        pos += 8 * ndim
+        arr = numpy.frombuffer(data, dtype, offset=pos).reshape(shape)
+        if ndim == 0:
+            return arr[()]
+        return arr.copy()
+    raise ValueError('Incompatible value in column "bval"', tag)
+
+
+# In the document layout, the flattened state of a job is a JSON object.
+# Strings, ints and floats are JSON values, the other values are stored as
+# {"$b": <base64 of the bval column>} and the floats JSON does not have as
+# {"$f": "nan"}, {"$f": "inf"} or {"$f": "-inf"}.
+
+
+def _encode_doc_val(val):
+    """Return the JSON value used to store `val` in a document, with the
+    type conversion heuristic of `_encode_val`."""
+    if isinstance(val, (str, unicode)):
+        return val
+    elif isinstance(val, float):
+        if str(val) in ('nan', 'inf', '-inf'):
+            return {'$f': str(val)}
+        return val
+    elif isinstance(val, int):
+        return int(val)
+    return {'$b': base64.b64encode(_encode_bval(val))}
+
+
+def _decode_doc_val(val, _trees=None):
+    """Return the value stored as `val` in a document, see
+    `_encode_doc_val`."""
+    if isinstance(val, dict):
+        if '$b' in val:
+            return _decode_bval(base64.b64decode(val['$b']), _trees)
+        return float(val['$f'])
+    return val
+
+
+def _dump_doc(doc):
+    return json.dumps(doc, separators=(',', ':'), sort_keys=True)
+
+
+def _sql_string(s):
+    """Return the SQL literal of the string `s`."""
+    return "'%s'" % s.replace("'", "''")
+
+
+def _json_path(key):
+    """Return the sqlite JSON path of `key` in a document."""
+    if '"' in key:
+        raise KeyError('the keys of the document layout cannot contain "',
+                       key)
+    return '$."%s"' % key
+
+
+def _in_ints(col, ints):
+    """Return the clause `col IN (ints)`, with the integers inlined.
+
+    Binding thousands of parameters costs more than the query, and sqlite
+    limits their number.
+    """
+    return col.op('IN')(literal_column(
+        '(%s)' % ','.join(['%d' % i for i in ints])))
+
+
+def _promoted_column(colname, type):
+    """Return the indexed trial table column of a promoted key of type
+    `type`: 'i', 'f' or 's', as in the keyval table."""
+    coltype = {'i': BigInteger, 'f': Float(53), 's': Text}[type]
+    return Column(colname, coltype, index=True)
+
+
+def _fill_promoted(conn, t, kv, key, colname, type, ids=None):
+    """Set the column `colname` of the trial table `t` to the values of
+    the promoted `key` in the keyval table `kv`, for all the dictionaries
+    or those of `ids`."""
+    value = (select([sqlalchemy.func.max(kv.c[type + 'val'])],
+                    (kv.c.dict_id == t.c.id) & (kv.c.name == key) &
+                    (kv.c.type == type))
+             .correlate(t).as_scalar())
+    update = t.update().values({colname: value})
+    if ids is not None:
+        update = update.where(_in_ints(t.c.id, ids))
+    conn.execute(update)
+
+
+def _promoted_val(type, val):
+    """Return the value of a promoted column of type `type` for `val`.
+
+    This is None when `val` is stored in another keyval column than
+    `type`, so that filtering on the column matches the same dictionaries
+    as filtering on the key-value pairs.
+    """
+    row = _encode_val(val)
+    if row['type'] != type:
+        return None
+    return row[type + 'val']
+
+
+class _LRUCache(object):
+
+    """A bounded mapping that forgets the least recently used entries."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = {}
+        self._tick = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        self._tick += 1
+        entry[1] = self._tick
+        return entry[0]
+
+    def put(self, key, value):
+        self._tick += 1
+        self._data[key] = [value, self._tick]
+        if len(self._data) > self.maxsize:
+            # Forget the least recently used tenth at once, so that
+            # sorting the entries does not happen on every put.
+            by_use = sorted(self._data.iteritems(), key=lambda kv: kv[1][1])
+            for key, entry in by_use[:len(self._data) - self.maxsize * 9 // 10]:
+                del self._data[key]
+
+    def clear(self):
+        self._data.clear()
+
+
+def _identity(d):
+    """Return the id of the dictionary `d` in the database, without loading
+    it, or None if it was never flushed."""
+    key = instance_state(d).key
+    if key is None:
+        return None
+    return key[1][0]
+
+
+def _cache_valid(d, write):
+    """Tell if the cached dictionary `d` is loaded and was last written at
+    `write`."""
+    # expired attributes are missing from the instance __dict__
+    return (('_attrs' in d.__dict__ or 'doc' in d.__dict__) and
+            'write' in d.__dict__ and d.__dict__['write'] == write)
+
+
+if sql.sqlalchemy_ok:
+    class _JSONB(UserDefinedType):
+
+        """The JSONB type of postgres."""
+
+        def get_col_spec(self):
+            return 'JSONB'
+
+    class _JSONDoc(TypeDecorator):
+
+        """A JSON object: JSONB on postgres, text elsewhere."""
+
+        impl = Text
+
+        def load_dialect_impl(self, dialect):
+            if dialect.name in ('postgres', 'postgresql'):
+                return _JSONB()
+            return dialect.type_descriptor(Text())
+
+        def process_bind_param(self, value, dialect):
+            if value is None:
+                return None
+            return _dump_doc(value)
+
+        def process_result_value(self, value, dialect):
+            # psycopg2 may already have parsed it
+            if value is None or isinstance(value, dict):
+                return value
+            return json.loads(value)
+
+
 class DbHandle (object):
 
     """
@@ -103,18 +454,37 @@ class DbHandle (object):
 
     e_bad_table = 'incompatible columns in table'
 
-    def __init__(h_self, Session, engine, dict_table, pair_table):
+    def __init__(h_self, Session, engine, dict_table, pair_table,
+                 promoted=None, promoted_table=None, layout='keyval'):
         h_self._engine = engine
         h_self._dict_table = dict_table
         h_self._pair_table = pair_table
+        # key -> (column name, type) of the keys that have a column of
+        # their own in the trial table, see promote_key
+        h_self._promoted = dict(promoted or {})
+        h_self._promoted_table = promoted_table
+        # 'keyval': one row per key in pair_table
+        # 'document': one JSON object per dictionary in the 'doc' column
+        # of dict_table, and no pair_table
+        h_self.layout = layout
+        # statements of the hot paths, and their compiled forms, see
+        # _statement
+        h_self._statements = {}
+        h_self._compiled_cache = {}
 
         # TODO: replace this crude algorithm (ticket #17)
-        if ['id', 'create', 'write', 'read', 'status', 'priority', 'hash'] != [c.name for c in dict_table.c]:
+        if layout == 'document':
+            extra_columns = ['doc']
+        else:
+            extra_columns = sorted(c for c, t in h_self._promoted.values())
+        if (['id', 'create', 'write', 'read', 'status', 'priority', 'hash', 'heartbeat'] +
+                extra_columns != [c.name for c in dict_table.c]):
             raise ValueError(h_self.e_bad_table, dict_table)
-        if ['id', 'dict_id', 'name', 'type', 'ival', 'fval', 'sval', 'bval'] != [c.name for c in pair_table.c]:
+        if layout == 'keyval' and ['id', 'dict_id', 'name', 'type', 'ival', 'fval', 'sval', 'bval'] != [c.name for c in pair_table.c]:
             raise ValueError(h_self.e_bad_table, pair_table)
 
         h_self._session_fn = Session
+        h_self._cache = None
 
         class KeyVal (object):
 
@@ -130,52 +500,21 @@ class DbHandle (object):
                 return "<Param(%s,'%s', %s)>" % (k_self.id, k_self.name, repr(k_self.val))
 
             def __get_val(k_self):
-                val = None
-                if k_self.type == 'i':
-                    val = int(k_self.ival)
-                elif k_self.type == 'f':
-                    if k_self.fval is None:
-                        val = float('nan')
-                    else:
-                        val = float(k_self.fval)
-                elif k_self.type == 'b':
-                    val = eval(str(k_self.bval))
-                elif k_self.type == 's':
-                    val = k_self.sval
-                else:
-                    raise ValueError('Incompatible value in column "type"',
-                                     k_self.type)
-                return val
+                return _decode_val(k_self.type, k_self.ival, k_self.fval,
+                                   k_self.sval, k_self.bval)
 
             def __set_val(k_self, val):
-                k_self.ival = None
-                k_self.fval = None
-                k_self.bval = None
-                k_self.sval = None
-
-                if isinstance(val, (str, unicode)):
-                    k_self.type = 's'
-                    k_self.sval = val
-                elif isinstance(val, float):
-                    k_self.type = 'f'
-                    # special cases
-                    if str(val) in ('nan', 'inf', '-inf'):
-                        # Special cases not handled by SQLAlchemy.
-                        # To avoid crashes, setting value to None
-                        k_self.fval = None
-                    else:
-                        k_self.fval = float(val)
-                elif isinstance(val, int):
-                    k_self.type = 'i'
-                    k_self.ival = int(val)
-                else:
-                    k_self.type = 'b'
-                    k_self.bval = repr(val)
-                    assert eval(k_self.bval) == val
+                row = _encode_val(val)
+                k_self.type = row['type']
+                k_self.ival = row['ival']
+                k_self.fval = row['fval']
+                k_self.sval = row['sval']
+                k_self.bval = row['bval']
 
             val = property(__get_val, __set_val)
 
-        mapper(KeyVal, pair_table)
+        if layout == 'keyval':
+            mapper(KeyVal, pair_table)
 
         class Dict (object):
 
@@ -190,6 +529,9 @@ class DbHandle (object):
 
             """
             def __init__(d_self, session=None):
+                d_self.create = d_self.write = datetime.datetime.now()
+                if layout == 'document':
+                    d_self.doc = {}
                 if session is None:
                     s = h_self._session_fn()
                     s.add(d_self)  # d_self transient -> pending
@@ -206,10 +548,13 @@ class DbHandle (object):
             #
 
             def __contains__(d_self, key):
-                for a in d_self._attrs:
-                    if a.name == key:
+                batch = getattr(d_self, '_batch', None)
+                if batch is not None:
+                    if key in batch[0]:
                         return True
-                return False
+                    if key in batch[1]:
+                        return False
+                return d_self._has(key)
 
             def __eq__(self, other):
                 return dict(self) == dict(other)
@@ -218,13 +563,22 @@ class DbHandle (object):
                 return dict(self) != dict(other)
 
             def __getitem__(d_self, key):
-                for a in d_self._attrs:
-                    if a.name == key:
-                        return a.val
-                raise KeyError(key)
+                batch = getattr(d_self, '_batch', None)
+                if batch is not None:
+                    if key in batch[0]:
+                        return batch[0][key]
+                    if key in batch[1]:
+                        raise KeyError(key)
+                return d_self._get(key)
 
             def __setitem__(d_self, key, val, session=None):
-                if session is None:
+                batch = getattr(d_self, '_batch', None)
+                if session is None and batch is not None:
+                    if key in d_self._forbidden_keys:
+                        raise KeyError(key)
+                    batch[0][key] = val
+                    batch[1].discard(key)
+                elif session is None:
                     s = h_self._session_fn()
                     s.add(d_self)
                     d_self._set_in_session(key, val, s)
@@ -236,6 +590,14 @@ class DbHandle (object):
                     d_self._set_in_session(key, val, s)
 
             def __delitem__(d_self, key, session=None):
+                batch = getattr(d_self, '_batch', None)
+                if session is None and batch is not None:
+                    if key not in d_self:
+                        raise KeyError(key)
+                    batch[0].pop(key, None)
+                    if d_self._has(key):
+                        batch[1].add(key)
+                    return
                 if session is None:
                     s = h_self._session_fn()
                     commit_close = True
@@ -244,18 +606,9 @@ class DbHandle (object):
                     commit_close = False
                 s.add(d_self)
 
-                # find the item to delete in d_self._attrs
-                to_del = None
-                for i, a in enumerate(d_self._attrs):
-                    if a.name == key:
-                        assert to_del is None
-                        to_del = (i, a)
-                if to_del is None:
+                if not d_self._has(key):
                     raise KeyError(key)
-                else:
-                    i, a = to_del
-                    s.delete(a)
-                    del d_self._attrs[i]
+                d_self._set_many_in_session([], [key], s)
                 if commit_close:
                     s.commit()
                     s.close()
@@ -267,32 +620,31 @@ class DbHandle (object):
                 return d_self.items()
 
             def items(d_self):
-                return [(kv.name, kv.val) for kv in d_self._attrs]
+                return d_self._items()
 
             def keys(d_self):
-                return [kv.name for kv in d_self._attrs]
+                return [k for k, v in d_self._items()]
 
             def values(d_self):
-                return [kv.val for kv in d_self._attrs]
+                return [v for k, v in d_self._items()]
 
-            def update_simple(d_self, dct, session, **kwargs):
+            def update_simple(d_self, dct, session, _delete_keys=(), **kwargs):
                 """
                 Make an dict-like update to self in the given session.
 
                 :param dct: a dictionary to union with the key-value pairs in self
                 :param session: an open sqlalchemy session
+                :param _delete_keys: keys to remove from self, if present
 
                 :note: This function does not commit the session.
 
                 :note: This function may raise `psycopg2.OperationalError`.
                 """
                 session.add(d_self)
-                for k, v in dct.iteritems():
-                    d_self._set_in_session(k, v, session)
-                for k, v in kwargs.iteritems():
-                    d_self._set_in_session(k, v, session)
+                d_self._set_many_in_session(dct.items() + kwargs.items(),
+                                            _delete_keys, session)
 
-            def update_in_session(d_self, dct, session, _recommit_times=5, _recommit_waitsecs=10, **kwargs):
+            def update_in_session(d_self, dct, session, _recommit_times=5, _recommit_waitsecs=10, _delete_keys=(), **kwargs):
                 """Make a dict-like update in the given session.
 
                 More robust than update_simple, it will try to recommit
@@ -311,7 +663,9 @@ class DbHandle (object):
                 """
                 while True:
                     try:
-                        d_self.update_simple(dct, session, **kwargs)
+                        d_self.update_simple(dct, session,
+                                             _delete_keys=_delete_keys,
+                                             **kwargs)
                         session.commit()
                         break
                     except Exception:
@@ -352,6 +706,40 @@ class DbHandle (object):
                             raise
                 session.close()
 
+            @contextlib.contextmanager
+            def batch(d_self, _recommit_times=5, _recommit_waitsecs=10):
+                """Group the changes made to self in a with-block in one
+                transaction.
+
+                Inside the block, item assignments and deletions that are
+                not given a session are only recorded, and `d[key]` and
+                `key in d` see them.  When the block exits normally, they
+                are written with `update`, which commits once and retries
+                like it.  If the block raises, they are discarded.
+
+                Example::
+
+                    with dbstate.batch():
+                        dbstate['jobman.status'] = ERR_START
+                        dbstate['jobman.sql.error'] = msg
+                        del dbstate['jobman.sql.host_name']
+
+                Nested batches are merged into the outermost one.
+                """
+                if getattr(d_self, '_batch', None) is not None:
+                    yield d_self
+                    return
+                batch = d_self._batch = ({}, set())
+                try:
+                    yield d_self
+                finally:
+                    d_self._batch = None
+                sets, deletes = batch
+                if sets or deletes:
+                    d_self.update(sets, _recommit_times=_recommit_times,
+                                  _recommit_waitsecs=_recommit_waitsecs,
+                                  _delete_keys=list(deletes))
+
             def get(d_self, key, default):
                 try:
                     return d_self[key]
@@ -399,39 +787,151 @@ class DbHandle (object):
             # helper routine by update() and __setitem__
             def _set_in_session(d_self, key, val, session):
                 """Modify an existing key or create a key to hold val"""
-
-                # FIRST SOME MIRRORING HACKS
-                if key == 'jobman.id':
-                    ival = int(val)
-                    d_self.id = ival
-                if key == 'jobman.status':
-                    ival = int(val)
-                    d_self.status = ival
-                if key == 'jobman.sql.priority':
-                    fval = float(val)
-                    d_self.priority = fval
-                if key == 'jobman.hash':
-                    ival = int(val)
-                    d_self.hash = ival
-
-                if key in d_self._forbidden_keys:
-                    raise KeyError(key)
-                created = None
-                for i, a in enumerate(d_self._attrs):
-                    if a.name == key:
-                        assert created == None
-                        created = h_self._KeyVal(key, val)
-                        d_self._attrs[i] = created
-                if not created:
-                    created = h_self._KeyVal(key, val)
-                    d_self._attrs.append(created)
-                session.add(created)
-
-        mapper(Dict, dict_table,
-               properties={
-                   '_attrs': relation(KeyVal,
-                                      cascade="all, delete-orphan")
-               })
+                d_self._set_many_in_session([(key, val)], (), session)
+
+            def _set_many_in_session(d_self, items, delete_keys, session):
+                """Set the (key, val) pairs `items`, and remove the keys
+                of `delete_keys` that are present."""
+                # values of the trial table columns
+                columns = {}
+                for key, val in items:
+                    # FIRST SOME MIRRORING HACKS
+                    if key == 'jobman.id':
+                        ival = int(val)
+                        columns['id'] = ival
+                    if key == 'jobman.status':
+                        ival = int(val)
+                        columns['status'] = ival
+                        if ival == sql.START:
+                            h_self._notify(session)
+                    if key == 'jobman.sql.priority':
+                        fval = float(val)
+                        columns['priority'] = fval
+                    if key == 'jobman.hash':
+                        ival = int(val)
+                        columns['hash'] = ival
+                    if key in h_self._promoted:
+                        colname, type = h_self._promoted[key]
+                        columns[colname] = _promoted_val(type, val)
+
+                    if key in d_self._forbidden_keys:
+                        raise KeyError(key)
+                dict_id = _identity(d_self)
+                if dict_id is not None and columns.get('id', dict_id) != dict_id:
+                    # changing the primary key is left to SqlAlchemy
+                    dict_id = None
+                if dict_id is None or layout == 'document':
+                    # deleting a missing pair is a no-op in the database
+                    delete_keys = [k for k in delete_keys if d_self._has(k)]
+                for key in delete_keys:
+                    if key in h_self._promoted:
+                        columns[h_self._promoted[key][0]] = None
+                if not (items or delete_keys):
+                    return
+                columns['write'] = datetime.datetime.now()
+                if dict_id is None:
+                    for colname, val in columns.iteritems():
+                        setattr(d_self, colname, val)
+                    d_self._store(items, delete_keys, session)
+                    return
+                # The dictionary is in the database: write the changes
+                # with the cached statements of the handle, instead of
+                # going through the unit of work of SqlAlchemy.
+                conn = h_self._cached_conn(session)
+                params = dict((c, v) for c, v in columns.iteritems()
+                              if c in h_self._dict_table.c)
+                params['b_id'] = dict_id
+                d_self._store_rows(conn, dict_id, params, items, delete_keys)
+                for colname, val in columns.iteritems():
+                    set_committed_value(d_self, colname, val)
+
+            # The storage of the key-value pairs, in the layout of the table
+            if layout == 'keyval':
+                def _has(d_self, key):
+                    return key in d_self._attrs
+
+                def _get(d_self, key):
+                    return d_self._attrs[key].val
+
+                def _items(d_self):
+                    return [(kv.name, kv.val)
+                            for kv in d_self._attrs.values()]
+
+                def _store_rows(d_self, conn, dict_id, trial_params, items,
+                                delete_keys):
+                    conn.execute(h_self._statement('trial_update'),
+                                 trial_params)
+                    h_self._set_pairs(
+                        conn, [(dict_id, key, val) for key, val in items])
+                    if delete_keys:
+                        conn.execute(h_self._statement('pair_delete'),
+                                     [dict(b_dict_id=dict_id, b_name=key)
+                                      for key in delete_keys])
+                    if '_attrs' in d_self.__dict__:
+                        # reloaded from the database when next used
+                        object_session(d_self).expire(d_self, ['_attrs'])
+
+                def _store(d_self, items, delete_keys, session):
+                    for key, val in items:
+                        if key in d_self._attrs:
+                            # update the existing row in place
+                            d_self._attrs[key].val = val
+                        else:
+                            created = h_self._KeyVal(key, val)
+                            d_self._attrs[key] = created
+                            session.add(created)
+                    for key in delete_keys:
+                        session.delete(d_self._attrs[key])
+                        del d_self._attrs[key]
+            else:
+                def _has(d_self, key):
+                    return key in d_self.doc
+
+                def _get(d_self, key):
+                    return _decode_doc_val(d_self.doc[key])
+
+                def _items(d_self):
+                    trees = {}
+                    return [(k, _decode_doc_val(v, trees))
+                            for k, v in d_self.doc.items()]
+
+                def _store_rows(d_self, conn, dict_id, trial_params, items,
+                                delete_keys):
+                    # Only the given keys are changed in the database, so
+                    # the concurrent changes of the others are kept.  The
+                    # loaded document is updated in place, which SqlAlchemy
+                    # does not see.
+                    patch = dict((k, _encode_doc_val(v)) for k, v in items)
+                    t = h_self._dict_table
+                    del trial_params['b_id']
+                    conn.execute(t.update().where(t.c.id == dict_id)
+                                 .values(doc=h_self._doc_merge(patch,
+                                                               delete_keys),
+                                         **trial_params))
+                    d_self._patch_doc(d_self.doc, patch, delete_keys)
+
+                def _store(d_self, items, delete_keys, session):
+                    patch = dict((k, _encode_doc_val(v)) for k, v in items)
+                    d_self.doc = dict(d_self.doc)
+                    d_self._patch_doc(d_self.doc, patch, delete_keys)
+
+                def _patch_doc(d_self, doc, patch, delete_keys):
+                    for key in delete_keys:
+                        del doc[key]
+                    doc.update(patch)
+
+        if layout == 'keyval':
+            # _attrs is a dictionary name -> KeyVal, kept up to date by
+            # SqlAlchemy whenever it is loaded or refreshed, so key lookups
+            # do not need to scan all the pairs.
+            mapper(Dict, dict_table,
+                   properties={
+                       '_attrs': relation(KeyVal,
+                                          cascade="all, delete-orphan",
+                                          collection_class=attribute_mapped_collection('name'))
+                   })
+        else:
+            mapper(Dict, dict_table)
 
         class _Query (object):
 
@@ -440,12 +940,25 @@ class DbHandle (object):
             _query - SqlAlchemy.Query object
             """
 
-            def __init__(q_self, query):
+            def __init__(q_self, query, chunk_size=None):
                 q_self._query = query
+                q_self._chunk_size = chunk_size
 
             def __iter__(q_self):
+                if q_self._chunk_size:
+                    return (d for chunk in
+                            h_self.iter_chunks(q_self, q_self._chunk_size)
+                            for d in chunk)
                 return q_self.all().__iter__()
 
+            def yield_per(q_self, chunk_size):
+                """Return a Query object whose iteration loads `chunk_size`
+                dictionaries at a time, see L{DbHandle.iter_chunks}.
+
+                This must be the last call in a chain of filters.
+                """
+                return h_self._Query(q_self._query, chunk_size)
+
             def __getitem__(q_self, item):
                 return q_self._query.__getitem__(item)
 
@@ -456,14 +969,45 @@ class DbHandle (object):
                 # Note: when we add new types to the key columns, add them here
                 q = q_self._query
                 T = h_self._Dict
+                if layout == 'document':
+                    return h_self._Query(q.filter(h_self._doc_eq(kw, arg)))
+
+                # The matching pairs are looked up first and their
+                # dictionaries then, which uses the (name, value) indexes of
+                # the keyval table.  The type is redundant with the value
+                # column, but it lets postgres use the partial ones, see
+                # _composite_indexes.
+                kv = h_self._pair_table
                 if isinstance(arg, (str, unicode)):
-                    q = q.filter(T._attrs.any(name=kw, sval=arg))
+                    match = ((kv.c.name == kw) & (kv.c.type == 's') &
+                             (kv.c.sval == arg))
+                    if len(arg) < _SVAL_INDEX_MAXLEN:
+                        match = match & (
+                            sqlalchemy.func.length(kv.c.sval) <
+                            literal_column(str(_SVAL_INDEX_MAXLEN)))
                 elif isinstance(arg, float):
-                    q = q.filter(T._attrs.any(name=kw, fval=arg))
+                    match = ((kv.c.name == kw) & (kv.c.type == 'f') &
+                             (kv.c.fval == arg))
                 elif isinstance(arg, int):
-                    q = q.filter(T._attrs.any(name=kw, ival=arg))
+                    match = ((kv.c.name == kw) & (kv.c.type == 'i') &
+                             (kv.c.ival == arg))
                 else:
-                    q = q.filter(T._attrs.any(name=kw, bval=repr(arg)))
+                    # also match the untagged reprs of older versions
+                    match = ((kv.c.name == kw) &
+                             ((kv.c.bval == _encode_bval(arg)) |
+                              (kv.c.bval == repr(arg))))
+                in_pairs = T.id.in_(select([kv.c.dict_id], match))
+                val = None
+                if kw in h_self._promoted:
+                    colname, type = h_self._promoted[kw]
+                    val = _promoted_val(type, arg)
+                if val is not None:
+                    col = getattr(T, colname)
+                    # The handles that did not know of the column leave it
+                    # NULL, until promote_key catches up.
+                    q = q.filter((col == val) | ((col == None) & in_pairs))
+                else:
+                    q = q.filter(in_pairs)
 
                 return h_self._Query(q)
 
@@ -473,22 +1017,150 @@ class DbHandle (object):
                     rval = rval.filter_eq(key, val)
                 return rval
 
+            def filter_status(q_self, *statuses):
+                """Return a Query object that restricts to dictionaries
+                whose jobman.status is one of `statuses`
+
+                This uses the indexed status column of the trial table
+                instead of the key-value pairs.
+                """
+                q = q_self._query
+                T = h_self._Dict
+
+                q = q.filter(T.status.in_(statuses))
+
+                return h_self._Query(q)
+
+            def filter_ids(q_self, ids):
+                """Return a Query object that restricts to the dictionaries
+                whose id is in `ids`"""
+                q = q_self._query
+                T = h_self._Dict
+
+                ids = list(ids)
+                if ids:
+                    q = q.filter(_in_ints(T.id, ids))
+                else:
+                    q = q.filter(sqlalchemy.sql.false())
+
+                return h_self._Query(q)
+
+            def order_by(q_self, key, desc=False, limit=None, offset=None):
+                """Return a Query object sorted by the value of `key`, and
+                optionally sliced, in the database.
+
+                The key-value pair of `key` is joined and sorted on its
+                typed column: `ival`/`fval` if `key` holds numbers, `sval`
+                if it holds strings.  Dictionaries without `key` come last.
+                A promoted key is sorted on its trial table column, without
+                join, and the values of another type than the column come
+                last too; the dictionaries whose column was left NULL by
+                handles that did not know of it are sorted on their
+                key-value pair.  In the document layout, the values are sorted
+                as the database sorts JSON values, numbers before strings.
+                Calls can be chained to sort on several keys.
+
+                @raise ValueError: if `key` holds pickled values, or both
+                numbers and strings.
+                """
+                q = q_self._query
+                T = h_self._Dict
+                if layout == 'keyval':
+                    kv = aliased(h_self._KeyVal)
+                if layout == 'document' or key in h_self._promoted:
+                    types = None
+                else:
+                    types = set(r[0] for r in q.session.query(
+                        h_self._KeyVal.type).filter_by(name=key).distinct())
+                if layout == 'document':
+                    col = h_self._doc_value(key)
+                elif types is None:
+                    colname, type = h_self._promoted[key]
+                    pairs = h_self._pair_table
+                    # only evaluated where the column is NULL
+                    value = (select([sqlalchemy.func.max(
+                                pairs.c[type + 'val'])],
+                                    (pairs.c.dict_id == T.id) &
+                                    (pairs.c.name == key) &
+                                    (pairs.c.type == type))
+                             .correlate(h_self._dict_table).as_scalar())
+                    col = sqlalchemy.func.coalesce(getattr(T, colname), value)
+                elif not types:
+                    col = None
+                elif types <= set(['i', 'f']):
+                    if types == set(['i']):
+                        col = kv.ival
+                    elif types == set(['f']):
+                        col = kv.fval
+                    else:
+                        col = sqlalchemy.func.coalesce(kv.fval, kv.ival)
+                elif types == set(['s']):
+                    col = kv.sval
+                else:
+                    raise ValueError('cannot sort on the values of key %r,'
+                                     ' of types %s' % (key, sorted(types)))
+
+                if col is not None:
+                    if types is not None:
+                        q = q.outerjoin((kv, (kv.dict_id == T.id) &
+                                         (kv.name == key)))
+                    if desc:
+                        q = q.order_by(col == None, col.desc())
+                    else:
+                        q = q.order_by(col == None, col)
+                if offset:
+                    q = q.offset(offset)
+                if limit is not None:
+                    q = q.limit(limit)
+
+                return h_self._Query(q)
+
+            def ids(q_self):
+                """Return the ids of the matching dictionaries, without
+                loading them."""
+                return [r[0] for r in
+                        q_self._query.values(h_self._Dict.id)]
+
+            def select_keys(q_self, *keys, **kwargs):
+                """Return an iterator over ``(id, v1, v2, ...)`` tuples, the
+                values of `keys` in the matching dictionaries.
+
+                Only the requested key-value pairs are fetched, see
+                L{DbHandle.get_keys}, which takes the same `default` and
+                `chunk` keyword arguments.
+                """
+                return h_self.get_keys(q_self.ids(), keys, **kwargs)
+
             def filter_missing(q_self, kw):
                 """Return a Query object that restricts to dictionaries
                 NOT containing the given keyword"""
                 q = q_self._query
                 T = h_self._Dict
 
-                q = q.filter(not_(T._attrs.any(name=kw)))
+                if layout == 'document':
+                    q = q.filter(not_(h_self._doc_has(kw)))
+                else:
+                    q = q.filter(not_(T._attrs.any(name=kw)))
 
                 return h_self._Query(q)
 
             def all(q_self):
                 """Return an iterator over all matching dictionaries.
 
+                With the cache enabled (see L{DbHandle.enable_cache}), only
+                the ids and write times of the matches are fetched, and the
+                dictionaries that changed or are not cached are loaded;
+                the returned dictionaries are then detached from the
+                session.
+
                 See L{SqlAlchemy.Query}
                 """
-                return q_self._query.all()
+                if h_self._cache is None:
+                    return q_self._query.all()
+                T = h_self._Dict
+                return h_self._cached_dicts(
+                    q_self._query.session,
+                    list(q_self._query.values(T.id, T.write)))
 
             def count(q_self):
                 """Return the number of matching dictionaries.
@@ -515,7 +1187,8 @@ class DbHandle (object):
 
                 # order_by is not easy to do in SQL based on the data structures we're
                 # using.  Considering we support different data types, it may not be
-                # possible at all.
+                # possible at all.  See order_by for the keys holding only
+                # numbers or only strings.
                 #
                 # It would be easy if 'pivot' or 'crosstab' were provided as part of the
                 # underlying API, but they are not. For example, read this:
@@ -541,9 +1214,40 @@ class DbHandle (object):
 
     def __iter__(h_self):
         s = h_self.session()
-        rval = list(h_self.query(s).__iter__())
-        s.close()
-        return rval.__iter__()
+        try:
+            for chunk in h_self.iter_chunks(h_self.query(s)):
+                for d in chunk:
+                    yield d
+        finally:
+            s.close()
+
+    def iter_chunks(h_self, query, chunk_size=1000):
+        """Return an iterator over the dictionaries matched by `query`, as
+        lists of at most `chunk_size` dictionaries.
+
+        The dictionaries are loaded one chunk at a time, in id order, with
+        ``id > last_id`` queries, so memory use does not grow with the
+        number of matches and the first chunk comes right away.  Any order
+        of `query` is replaced by the id order.  The yielded dictionaries
+        are detached from the session of `query`, like those of `get`.
+        """
+        T = h_self._Dict
+        q = query._query.order_by(None).order_by(T.id)
+        session = q.session
+        last_id = None
+        while True:
+            if last_id is None:
+                chunk = q.limit(chunk_size).all()
+            else:
+                chunk = q.filter(T.id > last_id).limit(chunk_size).all()
+            if not chunk:
+                break
+            last_id = chunk[-1].id
+            for d in chunk:
+                session.expunge(d)
+            yield chunk
+            if len(chunk) < chunk_size:
+                break
 
     def insert_kwargs(h_self, session=None, **dct):
         """
@@ -586,29 +1290,625 @@ class DbHandle (object):
             session.commit()
         return rval
 
+    def insert_many(h_self, dcts, chunk=1000, session=None):
+        """Insert many dictionaries, bypassing the ORM.
+
+        Each chunk of `chunk` dictionaries goes in one transaction: the
+        trial rows are inserted first and their ids fetched back in bulk,
+        then all the key-value pairs of the chunk are inserted with a single
+        executemany.
+
+        With a `session`, the rows are written in its transaction instead,
+        and are only kept once the caller commits it.
+
+        @type dcts: iterable of dict-like instances whose keys are strings,
+        and values are either strings, integers, floats
+
+        @rtype: list of int
+        @return: the ids of the inserted dictionaries, in order
+
+        @note: Unlike L{insert}, no L{DbHandle._Dict} instance is created.
+        """
+        ids = []
+        batch = []
+        for dct in dcts:
+            batch.append(dct)
+            if len(batch) >= chunk:
+                ids.extend(h_self._insert_chunk(batch, session=session))
+                batch = []
+        if batch:
+            ids.extend(h_self._insert_chunk(batch, session=session))
+        return ids
+
+    def _insert_chunk(h_self, dcts, trial_rows=None, session=None):
+        """Insert the dictionaries `dcts` in one transaction, or in the
+        transaction of `session`, and return their ids.
+
+        @param trial_rows: the values of the trial table columns of each
+        dictionary, instead of those mirrored from its keys.
+        """
+        now = datetime.datetime.now()
+        given_rows = trial_rows
+        trial_rows = []
+        for i, dct in enumerate(dcts):
+            # Same mirroring hacks as in _set_in_session
+            row = dict(id=None, status=None, priority=None, hash=None,
+                       create=now, write=now)
+            for key in dct:
+                if key in h_self._Dict._forbidden_keys:
+                    raise KeyError(key)
+            if 'jobman.id' in dct:
+                row['id'] = int(dct['jobman.id'])
+            if 'jobman.status' in dct:
+                row['status'] = int(dct['jobman.status'])
+            if 'jobman.sql.priority' in dct:
+                row['priority'] = float(dct['jobman.sql.priority'])
+            if 'jobman.hash' in dct:
+                row['hash'] = int(dct['jobman.hash'])
+            for key, (colname, type) in h_self._promoted.iteritems():
+                row[colname] = None
+                if key in dct:
+                    row[colname] = _promoted_val(type, dct[key])
+            if given_rows is not None:
+                row.update(given_rows[i])
+            if h_self.layout == 'document':
+                row['doc'] = dict((k, _encode_doc_val(v))
+                                  for k, v in dct.iteritems())
+            trial_rows.append(row)
+
+        if session is not None:
+            # the caller commits or rolls back
+            return h_self._insert_rows(
+                session.connection(mapper=h_self._Dict), dcts, trial_rows)
+        conn = h_self._engine.connect()
+        try:
+            trans = conn.begin()
+            try:
+                ids = h_self._insert_rows(conn, dcts, trial_rows)
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+        finally:
+            conn.close()
+        return ids
+
+    def _insert_rows(h_self, conn, dcts, trial_rows):
+        ids = h_self._insert_trial_rows(conn, trial_rows)
+        if [r for r in trial_rows if r['status'] == sql.START]:
+            h_self._notify(conn)
+        if h_self.layout == 'document':
+            return ids
+        pair_rows = []
+        for dict_id, dct in zip(ids, dcts):
+            for name, val in dct.iteritems():
+                pair_row = _encode_val(val)
+                pair_row['dict_id'] = dict_id
+                pair_row['name'] = name
+                pair_rows.append(pair_row)
+        h_self._executemany(conn, h_self._pair_table, pair_rows)
+        return ids
+
+    def update_many(h_self, ids, dct, chunk=500):
+        """Set the key-value pairs of `dct` in all the dictionaries `ids`.
+
+        This is a set-based `update`: each key is written with one
+        ``UPDATE ... WHERE dict_id IN (...)`` per chunk of ids, and the
+        pairs that do not exist yet are inserted.  The trial columns
+        mirrored by `_set_in_session` are updated the same way.  All the
+        changes are done in one transaction.
+
+        @return: the number of dictionaries updated; ids that are not in
+        the database are ignored.
+        """
+        for key in dct:
+            if key in h_self._Dict._forbidden_keys:
+                raise KeyError(key)
+        # Same mirroring hacks as in _set_in_session
+        trial_values = {'write': datetime.datetime.now()}
+        if 'jobman.status' in dct:
+            trial_values['status'] = int(dct['jobman.status'])
+        if 'jobman.sql.priority' in dct:
+            trial_values['priority'] = float(dct['jobman.sql.priority'])
+        if 'jobman.hash' in dct:
+            trial_values['hash'] = int(dct['jobman.hash'])
+        for key, (colname, type) in h_self._promoted.iteritems():
+            if key in dct:
+                trial_values[colname] = _promoted_val(type, dct[key])
+        if h_self.layout == 'document':
+            trial_values['doc'] = h_self._doc_merge(
+                dict((k, _encode_doc_val(v)) for k, v in dct.iteritems()), ())
+            pair_values = []
+        else:
+            pair_values = [(name, _encode_val(val))
+                           for name, val in dct.iteritems()]
+
+        t = h_self._dict_table
+        kv = h_self._pair_table
+        ids = sorted(set(ids))
+        n_updated = 0
+        conn = h_self._engine.connect()
+        try:
+            trans = conn.begin()
+            try:
+                for i in xrange(0, len(ids), chunk):
+                    chunk_ids = [r[0] for r in conn.execute(
+                        select([t.c.id], _in_ints(t.c.id, ids[i:i + chunk])))]
+                    if not chunk_ids:
+                        continue
+                    n_updated += len(chunk_ids)
+                    conn.execute(t.update()
+                                 .where(_in_ints(t.c.id, chunk_ids))
+                                 .values(**trial_values))
+                    if trial_values.get('status') == sql.START:
+                        h_self._notify(conn)
+                    for name, values in pair_values:
+                        has_key = (_in_ints(kv.c.dict_id, chunk_ids) &
+                                   (kv.c.name == name))
+                        r = conn.execute(kv.update().where(has_key)
+                                         .values(**values))
+                        if r.rowcount == len(chunk_ids):
+                            continue
+                        have = set(row[0] for row in conn.execute(
+                            select([kv.c.dict_id], has_key)))
+                        new_rows = []
+                        for dict_id in chunk_ids:
+                            if dict_id not in have:
+                                row = dict(values)
+                                row['dict_id'] = dict_id
+                                row['name'] = name
+                                new_rows.append(row)
+                        h_self._executemany(conn, kv, new_rows)
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+        finally:
+            conn.close()
+        return n_updated
+
+    def _insert_trial_rows(h_self, conn, rows):
+        """Insert `rows` in the trial table, and return their ids.
+
+        Rows whose 'id' is None get a new id from the database.
+        """
+        t = h_self._dict_table
+        ids = [row['id'] for row in rows]
+        h_self._executemany(conn, t,
+                            [row for row in rows if row['id'] is not None])
+        new = [i for i, row in enumerate(rows) if row['id'] is None]
+        if not new:
+            return ids
+        new_rows = []
+        for i in new:
+            row = dict(rows[i])
+            del row['id']
+            new_rows.append(row)
+
+        dialect_name = h_self._engine.dialect.name
+        if dialect_name in ('postgres', 'postgresql'):
+            # reserve all the ids at once from the sequence behind 'id'
+            new_ids = [r[0] for r in conn.execute(
+                sqlalchemy.sql.text(
+                    "SELECT nextval(pg_get_serial_sequence(:t, 'id'))"
+                    " FROM generate_series(1, :n)"),
+                t=h_self._engine.dialect.identifier_preparer.format_table(t),
+                n=len(new_rows))]
+            for row, new_id in zip(new_rows, new_ids):
+                row['id'] = new_id
+            h_self._executemany(conn, t, new_rows)
+        elif dialect_name == 'sqlite':
+            first_id = conn.execute(
+                t.insert(), new_rows[0]).inserted_primary_key[0]
+            # The first insert took the database write lock until commit,
+            # so sqlite will number the following rows consecutively.
+            new_ids = range(first_id, first_id + len(new_rows))
+            for row, new_id in zip(new_rows, new_ids):
+                row['id'] = new_id
+            h_self._executemany(conn, t, new_rows[1:])
+        else:
+            new_ids = [conn.execute(t.insert(), row).inserted_primary_key[0]
+                       for row in new_rows]
+        for i, new_id in zip(new, new_ids):
+            ids[i] = new_id
+        return ids
+
+    def _executemany(h_self, conn, table, rows):
+        """Insert `rows`, dictionaries that all have the same keys.
+
+        The INSERT is compiled once and the rows go straight to the DBAPI
+        cursor of `conn` (hence in its current transaction): for large
+        batches, the per-row work done by `conn.execute` costs more than
+        the database itself.
+        """
+        if not rows:
+            return
+        dialect = h_self._engine.dialect
+        keys = rows[0].keys()
+        compiled = table.insert().compile(dialect=dialect, column_keys=keys)
+        if compiled.positional:
+            names = compiled.positiontup
+        else:
+            names = keys
+        procs = []
+        for i, name in enumerate(names):
+            proc = (table.c[name].type.dialect_impl(dialect)
+                    .bind_processor(dialect))
+            if proc is not None:
+                procs.append((i, proc))
+        params = []
+        for row in rows:
+            values = [row[name] for name in names]
+            for i, proc in procs:
+                values[i] = proc(values[i])
+            if compiled.positional:
+                params.append(values)
+            else:
+                params.append(dict(zip(names, values)))
+        cursor = conn.connection.cursor()
+        try:
+            cursor.executemany(str(compiled), params)
+        finally:
+            cursor.close()
+
     def query(h_self, session):
         """Construct an SqlAlchemy query, which can be subsequently filtered
         using the instance methods of DbQuery"""
+        if h_self.layout == 'document':
+            return h_self._Query(session.query(h_self._Dict))
         return h_self._Query(session.query(h_self._Dict)
                              .options(eagerload('_attrs')))
 
-    def createView(h_self, viewname, verbose=True):
+    # SQL expressions on the documents of the document layout
+
+    def _postgres(h_self):
+        return h_self._engine.dialect.name in ('postgres', 'postgresql')
+
+    def _doc_value(h_self, key):
+        """Return the value of `key` in the documents, as indexed by
+        `promote_key`."""
+        doc = h_self._dict_table.c.doc
+        # The key is inlined, so that the expression is the one indexed.
+        if h_self._postgres():
+            return doc.op('->')(literal_column(_sql_string(key)))
+        return sqlalchemy.func.json_extract(
+            doc, literal_column(_sql_string(_json_path(key))))
+
+    def _doc_has(h_self, key):
+        """Return the clause: the document has `key`."""
+        doc = h_self._dict_table.c.doc
+        if h_self._postgres():
+            return doc.op('?')(literal(key))
+        return sqlalchemy.func.json_type(
+            doc, literal_column(_sql_string(_json_path(key)))) != None
+
+    def _doc_eq(h_self, key, val):
+        """Return the clause: the value of `key` in the document is `val`.
+
+        On postgres, this is a containment test that the GIN index of the
+        documents serves.  Numbers are compared by value, so 1 and 1.0 are
+        equal, unlike in the keyval layout.
+        """
+        doc = h_self._dict_table.c.doc
+        val = _encode_doc_val(val)
+        if h_self._postgres():
+            return doc.op('@>')(cast(literal({key: val}, _JSONDoc()),
+                                     _JSONB()))
+        if isinstance(val, dict):
+            # json_extract returns objects as JSON text
+            val = _dump_doc(val)
+        return h_self._doc_value(key) == val
+
+    def _doc_merge(h_self, patch, delete_keys):
+        """Return the new value of the documents in which the keys
+        `delete_keys` are removed and the keys of `patch`, a dictionary of
+        JSON values, are set."""
+        doc = h_self._dict_table.c.doc
+        if h_self._postgres():
+            rval = sqlalchemy.func.coalesce(doc, literal_column("'{}'"))
+            for key in delete_keys:
+                rval = rval.op('-')(cast(literal(key), Text))
+            if patch:
+                rval = rval.op('||')(cast(literal(patch, _JSONDoc()),
+                                          _JSONB()))
+            return rval
+        rval = sqlalchemy.func.coalesce(doc, literal_column("'{}'"))
+        if delete_keys:
+            rval = sqlalchemy.func.json_remove(
+                rval, *[_json_path(k) for k in delete_keys])
+        if patch:
+            args = []
+            for key, val in patch.iteritems():
+                args.append(_json_path(key))
+                args.append(sqlalchemy.func.json(_dump_doc(val)))
+            rval = sqlalchemy.func.json_set(rval, *args)
+        return rval
 
-        s = h_self.session()
-        kv = h_self._KeyVal
-        d = h_self._Dict
+    # Waiting for new jobs
 
-        # If view already exists, drop it
-        drop_view_sql = 'DROP VIEW IF EXISTS %s' % viewname
+    def notify_channel(h_self):
+        """Return the name of the postgres channel on which the jobs
+        put in the START status are announced, jobman_<table>."""
+        name = getattr(h_self, 'tablename', None) or h_self._dict_table.name
+        # the channel is an identifier, at most 63 bytes long
+        return ('jobman_' + name)[:63]
 
+    def _notify(h_self, conn):
+        """Wake up the workers waiting in `wait_for_jobs`.
+
+        On postgres, this sends a NOTIFY on `notify_channel`, delivered when
+        the transaction of `conn` (a connection or a session) commits, and
+        only once per transaction.  Elsewhere, the workers poll the table.
+        """
+        if h_self._postgres():
+            conn.execute(sqlalchemy.sql.text('NOTIFY %s' % (
+                h_self._engine.dialect.identifier_preparer.quote_identifier(
+                    h_self.notify_channel()))))
+
+    def _has_start_jobs(h_self, conn):
+        t = h_self._dict_table
+        return conn.execute(select([t.c.id]).where(t.c.status == sql.START)
+                            .limit(1)).first() is not None
+
+    def wait_for_jobs(h_self, timeout=None, poll_min=0.1, poll_max=10.0):
+        """Block until there may be jobs in the START status.
+
+        On postgres, this listens on `notify_channel`, to which the
+        insertions and the status changes to START made through the
+        DbHandle send a notification, and returns as soon as one arrives.
+        Elsewhere, the status column is polled, every `poll_min` seconds at
+        first, up to every `poll_max` seconds when nothing happens.
+
+        Another worker may book the jobs first, so the caller should try to
+        book a job and wait again if there is none.
+
+        @param timeout: give up after that many seconds (None: never)
+        @rtype: bool
+        @return: False if the timeout was reached
+        """
+        if timeout is None:
+            deadline = None
+        else:
+            deadline = time.time() + timeout
+
+        def remaining(at_most):
+            if deadline is None:
+                return at_most
+            return max(0.0, min(at_most, deadline - time.time()))
+
+        if h_self._postgres():
+            return h_self._wait_for_notify(remaining)
+
+        delay = poll_min
+        while True:
+            conn = h_self._engine.connect()
+            try:
+                if h_self._has_start_jobs(conn):
+                    return True
+            finally:
+                conn.close()
+            sleep = remaining(delay)
+            if sleep <= 0:
+                return False
+            time.sleep(sleep)
+            delay = min(poll_max, delay * 2)
+
+    def _wait_for_notify(h_self, remaining):
+        conn = h_self._engine.raw_connection()
+        try:
+            dbapi_conn = conn.connection
+            old_level = dbapi_conn.isolation_level
+            # notifications are only received outside of a transaction
+            dbapi_conn.set_isolation_level(0)
+            cursor = dbapi_conn.cursor()
+            preparer = h_self._engine.dialect.identifier_preparer
+            channel = preparer.quote_identifier(h_self.notify_channel())
+            try:
+                cursor.execute('LISTEN %s' % channel)
+                # jobs may have come before the LISTEN
+                cursor.execute('SELECT id FROM %s WHERE status = %d LIMIT 1' % (
+                    preparer.format_table(h_self._dict_table), sql.START))
+                if cursor.fetchone() is not None:
+                    return True
+                while True:
+                    # wake up every minute to notice dead connections
+                    wait = remaining(60.0)
+                    if wait <= 0:
+                        return False
+                    if select_module.select([dbapi_conn], [], [], wait)[0]:
+                        dbapi_conn.poll()
+                        if dbapi_conn.notifies:
+                            del dbapi_conn.notifies[:]
+                            return True
+                    else:
+                        dbapi_conn.poll()
+            finally:
+                try:
+                    cursor.execute('UNLISTEN %s' % channel)
+                    cursor.close()
+                finally:
+                    dbapi_conn.set_isolation_level(old_level)
+        finally:
+            conn.close()
+
+    def _set_status_key(h_self, conn, dict_ids, status):
+        """Mirror `status` into the jobman.status key of the trials
+        `dict_ids`, in the transaction of `conn`.
+
+        This is the key side of the `_set_in_session` mirroring hack, for
+        code that updates the `status` column directly.
+        """
+        if status == sql.START:
+            h_self._notify(conn)
+        if h_self.layout == 'document':
+            t = h_self._dict_table
+            conn.execute(t.update().where(_in_ints(t.c.id, dict_ids))
+                         .values(doc=h_self._doc_merge(
+                             {sql.STATUS: int(status)}, ())))
+            return
+        h_self._set_pairs(h_self._cached_conn(conn),
+                          [(i, sql.STATUS, int(status)) for i in dict_ids])
+
+    # Statements of the hot paths (booking, saving, heartbeats)
+
+    def _statement(h_self, key, build=None):
+        """Return the statement cached under `key`, made the first time by
+        `build()`, or by the `_build_<key>` method of the handle.
+
+        Executed on a connection from `_cached_conn`, a cached statement is
+        compiled once, instead of every time: for the small statements run
+        by the workers, this is most of the work of SqlAlchemy.
+        """
+        try:
+            return h_self._statements[key]
+        except KeyError:
+            if build is None:
+                build = getattr(h_self, '_build_' + key)
+            stmt = h_self._statements[key] = build()
+            return stmt
+
+    def _cached_conn(h_self, conn):
+        """Return `conn`, a connection or a session, as a connection in the
+        same transaction that keeps the compiled cached statements."""
+        if not isinstance(conn, Connection):
+            conn = conn.connection(mapper=h_self._Dict)
+        return conn.execution_options(compiled_cache=h_self._compiled_cache)
+
+    def _build_trial_update(h_self):
+        t = h_self._dict_table
+        return t.update().where(t.c.id == bindparam('b_id'))
+
+    def _build_pair_update(h_self):
+        kv = h_self._pair_table
+        return kv.update().where((kv.c.dict_id == bindparam('b_dict_id')) &
+                                 (kv.c.name == bindparam('b_name')))
+
+    def _build_pair_insert(h_self):
+        return h_self._pair_table.insert()
+
+    def _build_pair_delete(h_self):
+        kv = h_self._pair_table
+        return kv.delete().where((kv.c.dict_id == bindparam('b_dict_id')) &
+                                 (kv.c.name == bindparam('b_name')))
+
+    def _build_heartbeat(h_self):
+        t = h_self._dict_table
+        return (t.update()
+                .where((t.c.id == bindparam('b_id')) &
+                       (t.c.status == sql.RUNNING))
+                .values(heartbeat=h_self._db_now()))
+
+    def _db_now(h_self):
+        """Return the current time of the database clock, in UTC, as an
+        SQL expression.
+
+        The heartbeats and the cutoff of `sql.reap_stale` are taken from
+        it, so that they do not depend on the clock and time zone of each
+        worker.
+        """
+        if h_self._engine.dialect.name in ('postgres', 'postgresql'):
+            return sqlalchemy.func.timezone('UTC', sqlalchemy.func.now(),
+                                            type_=DateTime)
+        # CURRENT_TIMESTAMP is in UTC in sqlite
+        return sqlalchemy.func.current_timestamp()
+
+    def _db_cutoff(h_self, seconds):
+        """Return the time of the database clock `seconds` ago, like
+        `_db_now`."""
+        if h_self._engine.dialect.name in ('postgres', 'postgresql'):
+            return h_self._db_now() - datetime.timedelta(seconds=seconds)
+        # same text format as CURRENT_TIMESTAMP, to compare with it
+        return sqlalchemy.func.datetime('now', '%r seconds' % -float(seconds),
+                                        type_=DateTime)
+
+    def _set_pairs(h_self, conn, pairs):
+        """Write the (dict_id, name, val) `pairs` in the keyval table, in
+        the transaction of `conn`: the existing pairs are updated in place,
+        the others inserted.
+        """
+        rows = []
+        for dict_id, name, val in pairs:
+            row = _encode_val(val)
+            row['b_dict_id'] = dict_id
+            row['b_name'] = name
+            rows.append(row)
+        if not rows:
+            return
+        update = h_self._statement('pair_update')
+        if len(rows) == 1:
+            done = conn.execute(update, rows[0]).rowcount == 1
+        else:
+            r = conn.execute(update, rows)
+            # psycopg2 does not count the rows of an executemany
+            done = (conn.dialect.supports_sane_multi_rowcount and
+                    r.rowcount == len(rows))
+        if done:
+            return
+        kv = h_self._pair_table
+        have = set(tuple(row) for row in conn.execute(
+            select([kv.c.dict_id, kv.c.name])
+            .where(_in_ints(kv.c.dict_id, set(r['b_dict_id'] for r in rows)) &
+                   kv.c.name.in_(list(set(r['b_name'] for r in rows))))))
+        new_rows = []
+        for row in rows:
+            if (row['b_dict_id'], row['b_name']) not in have:
+                row = dict(row)
+                row['dict_id'] = row.pop('b_dict_id')
+                row['name'] = row.pop('b_name')
+                new_rows.append(row)
+        if new_rows:
+            conn.execute(h_self._statement('pair_insert'), new_rows)
+
+    def _load_dicts(h_self, session, ids):
+        """Return the dictionaries `ids` loaded in `session`, highest
+        priority first, with cached statements.
+
+        The key-value pairs are loaded with a second statement, rather than
+        eagerly joined by a query that SqlAlchemy would compile every time.
+        """
+        if not ids:
+            return []
+        t = h_self._dict_table
+        kv = h_self._pair_table
+        n = len(ids)
+        in_ids = lambda col: col.in_([bindparam('b_id%i' % i)
+                                      for i in xrange(n)])
+        params = dict(('b_id%i' % i, dict_id) for i, dict_id in enumerate(ids))
+        conn = h_self._cached_conn(session)
+        dcts = list(session.query(h_self._Dict).instances(conn.execute(
+            h_self._statement(('load_dicts', n), lambda: (
+                select([t]).where(in_ids(t.c.id))
+                .order_by(t.c.priority.desc(), t.c.id))),
+            params)))
+        if h_self.layout == 'keyval':
+            attrs = dict((d.id, []) for d in dcts)
+            for pair in session.query(h_self._KeyVal).instances(conn.execute(
+                    h_self._statement(('load_pairs', n), lambda: (
+                        select([kv]).where(in_ids(kv.c.dict_id)))),
+                    params)):
+                attrs[pair.dict_id].append(pair)
+            for d in dcts:
+                set_committed_value(d, '_attrs', attrs[d.id])
+        return dcts
+
+    def _view_columns(h_self, session, keys=None):
+        """Return the columns of a view of the table, as a list of
+        (name, type character, column name, sqlalchemy type) tuples.
+
+        There is one column per distinct (name, type) pair of the keyval
+        table, restricted to the names in `keys` if it is not None.
+        """
+        if h_self.layout != 'keyval':
+            raise ValueError('views are only made of tables in the keyval'
+                             ' layout')
+        kv = h_self._KeyVal
         # Get column names
-        name_query = s.query(kv.name, kv.type).distinct()
+        name_query = session.query(kv.name, kv.type).distinct()
+        if keys is not None:
+            name_query = name_query.filter(kv.name.in_(list(keys)))
 
-        # Generate sub-queries for the big "join"
-        # and build the table structure of the view
-        cols = [Column('id', Integer, primary_key=True)]
+        rval = []
         safe_names = []
-        sub_queries = []
         for name, val_type_char in name_query.all():
             if val_type_char == 'i':
                 val_type = Integer
@@ -621,19 +1921,115 @@ class DbHandle (object):
             else:
                 raise ValueError('Incompatible value in column "type"',
                                  val_type_char)
-            val_type_string = val_type_char + 'val'
 
             safe_name = name.replace('_', '').replace('.', '_')
             if safe_name in safe_names:
                 safe_name += '_' + val_type_char
             safe_names.append(safe_name)
+            rval.append((name, val_type_char, safe_name, val_type))
+        return rval
+
+    def iter_pivot(h_self, columns, chunk=10000):
+        """Stream the table as rows of values, one per dictionary.
+
+        The key-value pairs are read in a single pass, ordered by
+        dictionary, through a server-side cursor on postgres, and pivoted
+        on the fly.  Only the dictionaries that have a key are read.
+
+        @param columns: the (name, type character) pairs of the values of
+        each row, as from `_view_columns`, without the 'b' ones.
+        @return: an iterator on lists of at most `chunk` rows, each row a
+        (dictionary id, list of values) pair.  Missing values are None.
+        """
+        kv = h_self._pair_table
+        index = dict(((name, type), i)
+                     for i, (name, type) in enumerate(columns))
+        n_columns = len(columns)
+        names = list(set(name for name, type in columns))
+        q = (select([kv.c.dict_id, kv.c.name, kv.c.type,
+                     kv.c.ival, kv.c.fval, kv.c.sval])
+             .where(kv.c.name.in_(names) & kv.c.type.in_(['i', 'f', 's']))
+             .order_by(kv.c.dict_id))
+        conn = h_self._engine.connect()
+        try:
+            result = conn.execution_options(stream_results=True).execute(q)
+            rows = []
+            dict_id = None
+            values = None
+            while True:
+                fetched = result.fetchmany(chunk)
+                for row_id, name, type, ival, fval, sval in fetched:
+                    if row_id != dict_id:
+                        if values is not None:
+                            rows.append((dict_id, values))
+                        dict_id = row_id
+                        values = [None] * n_columns
+                    i = index.get((name, type))
+                    if i is None:
+                        continue
+                    if type == 'i':
+                        values[i] = ival
+                    elif type == 'f':
+                        if fval is None:
+                            values[i] = float('nan')
+                        else:
+                            values[i] = fval
+                    else:
+                        values[i] = sval
+                if not fetched and values is not None:
+                    rows.append((dict_id, values))
+                if rows and (len(rows) >= chunk or not fetched):
+                    yield rows
+                    rows = []
+                if not fetched:
+                    break
+        finally:
+            conn.close()
+
+    def _view_sql(h_self, query):
+        """Return the SQL of `query`, with its parameters inlined.
+
+        SQL does not support binds in CREATE VIEW.  It just happened to
+        work with psycopg2 because binds are handled client-side.  Sqlite
+        does it server-side.
+        """
+        query = query.compile()
+        quoted_params = {}
+        for (key, val) in query.params.items():
+            quoted_params[key] = repr(val)
+        return str(query) % quoted_params
+
+    def _mapped_view(h_self, viewname, view_columns):
+        # Create mapper class for the view
+        class MappedView(object):
+            pass
+
+        cols = [Column('id', Integer, primary_key=True)]
+        cols += [Column(safe_name, val_type)
+                 for name, val_type_char, safe_name, val_type in view_columns]
+        t_view = Table(viewname, MetaData(), *cols)
+        mapper(MappedView, t_view)
+
+        return MappedView
+
+    def createView(h_self, viewname, verbose=True):
+
+        s = h_self.session()
+        kv = h_self._KeyVal
+        d = h_self._Dict
 
-            cols.append(Column(safe_name, val_type))
-            # print 'name =', name, ', type =', type
+        # If view already exists, drop it
+        drop_view_sql = 'DROP VIEW IF EXISTS %s' % viewname
+
+        # Generate sub-queries for the big "join"
+        # and build the table structure of the view
+        view_columns = h_self._view_columns(s)
+        safe_names = []
+        sub_queries = []
+        for name, val_type_char, safe_name, val_type in view_columns:
+            val_type_string = val_type_char + 'val'
+            safe_names.append(safe_name)
 
-            # SQL does not support binds in CREATE VIEW.
-            # it just happened to work with psycopg2 because binds are
-            # handled client-side.  Sqlite does it server-side.
             sub_query = select(
                 [kv.dict_id, column(val_type_string).label(safe_name)],
                 kv.name == literal_column("'%s'" % (name,)))
@@ -649,11 +2045,7 @@ class DbHandle (object):
         # Main "select" query, with the same information as the view
         main_query = select([d.id] + [column(name) for name in safe_names],
                             from_obj=big_join)
-        main_query = main_query.compile()
-        quoted_params = {}
-        for (key, val) in main_query.params.items():
-            quoted_params[key] = repr(val)
-        main_query_sql = str(main_query) % quoted_params
+        main_query_sql = h_self._view_sql(main_query)
 
         # Finally, the view creation command
         # Do not add 'OR REPLACE', it will break sqlite
@@ -669,22 +2061,93 @@ class DbHandle (object):
         s.commit()
         s.close()
 
-        # Create mapper class for the view
-        class MappedView(object):
-            pass
+        return h_self._mapped_view(viewname, view_columns)
 
-        t_view = Table(viewname, MetaData(), *cols)
-        mapper(MappedView, t_view)
+    def createPivotView(h_self, viewname, keys=None, materialized=False,
+                        verbose=True):
+        """Create a view with one column per key, like `createView`.
 
-        return MappedView
+        Instead of one outer join per key, the key-value pairs are pivoted
+        in a single pass: the trial table is joined once to the keyval
+        table, grouped by id, and each column is a conditional aggregate
+        ``MAX(CASE WHEN name = ... THEN val END)``.
 
-    def dropView(h_self, viewname, verbose=True):
+        @param keys: only make columns for these keys (default: all keys)
+        @param materialized: create a materialized view, which stores its
+        rows and is updated with `refreshView` (postgres only)
+        """
+        if materialized and h_self._engine.dialect.name not in (
+                'postgres', 'postgresql'):
+            raise ValueError('materialized views need postgres')
+
+        s = h_self.session()
+        t = h_self._dict_table
+        kv = h_self._pair_table
+        kv_b = kv.alias('kv_b')
+
+        def quote(name):
+            return literal_column("'%s'" % name.replace("'", "''"))
+
+        view_columns = h_self._view_columns(s, keys)
+        cols = [t.c.id]
+        for name, val_type_char, safe_name, val_type in view_columns:
+            if val_type_char == 'b':
+                # There is no MAX on binary columns in postgres, but
+                # there is at most one pair per name and dictionary
+                col = select([kv_b.c.bval],
+                             (kv_b.c.dict_id == t.c.id) &
+                             (kv_b.c.name == quote(name)) &
+                             (kv_b.c.type == literal_column("'b'"))
+                             ).as_scalar()
+            else:
+                val_col = kv.c[val_type_char + 'val']
+                col = sqlalchemy.func.max(sqlalchemy.sql.case(
+                    [(kv.c.name == quote(name), val_col)]))
+            cols.append(col.label(safe_name))
+
+        on = kv.c.dict_id == t.c.id
+        if keys is not None:
+            names = [quote(name) for name in keys]
+            if names:
+                on &= kv.c.name.op('IN')(literal_column(
+                    '(%s)' % ','.join(str(n) for n in names)))
+            else:
+                on &= sqlalchemy.sql.false()
+        main_query = select(cols, from_obj=[t.outerjoin(kv, on)],
+                            group_by=[t.c.id])
+        main_query_sql = h_self._view_sql(main_query)
+
+        kind = materialized and 'MATERIALIZED VIEW' or 'VIEW'
+        drop_view_sql = 'DROP %s IF EXISTS %s' % (kind, viewname)
+        create_view_sql = 'CREATE %s %s AS %s' % (kind, viewname,
+                                                   main_query_sql)
+        if verbose:
+            print 'Creating sql view with command:\n', create_view_sql
+
+        h_self._engine.execute(drop_view_sql)
+        h_self._engine.execute(create_view_sql)
+
+        s.close()
+
+        return h_self._mapped_view(viewname, view_columns)
+
+    def refreshView(h_self, viewname, verbose=True):
+        """Recompute the rows of a materialized view (postgres only)."""
+        refresh_view_sql = 'REFRESH MATERIALIZED VIEW %s' % viewname
+        if verbose:
+            print 'Refreshing sql view with command:\n', refresh_view_sql
+        h_self._engine.execute(refresh_view_sql)
+
+    def dropView(h_self, viewname, verbose=True, materialized=False):
 
         s = h_self.session()
         kv = h_self._KeyVal
         d = h_self._Dict
 
-        drop_view_sql = 'DROP VIEW %s' % (viewname)
+        if materialized:
+            drop_view_sql = 'DROP MATERIALIZED VIEW %s' % (viewname)
+        else:
+            drop_view_sql = 'DROP VIEW %s' % (viewname)
         if verbose:
             print 'Deleting sql view with command:\n', drop_view_sql
 
@@ -694,10 +2157,414 @@ class DbHandle (object):
         s.commit()
         s.close()
 
+    def ensure_indexes(h_self, online=True, verbose=False):
+        """Create the indexes of the trial and keyval tables that are missing.
+
+        `db_from_engine` only creates indexes along with new tables, so
+        tables made by older versions of jobman lack the newer ones.  With
+        `online` on postgres, they are built with CREATE INDEX
+        CONCURRENTLY, see `create_composite_indexes`.
+        """
+        return _create_missing_indexes(
+            h_self._engine, [t for t in (h_self._dict_table, h_self._pair_table)
+                             if t is not None], online, verbose)
+
+    def create_composite_indexes(h_self, online=True, verbose=False):
+        """Create the composite indexes of the trial and keyval tables
+        that are missing, and return their names.
+
+        These serve the booking of jobs, the lookup of the keys of given
+        dictionaries and `_Query.filter_eq`.  `db_from_engine` creates them
+        along with new tables.  With `online` on postgres, they are built
+        with CREATE INDEX CONCURRENTLY, which does not block the writes to
+        the table; if this fails, the invalid index is left in place and
+        must be dropped by hand.
+        """
+        engine = h_self._engine
+        preparer = engine.dialect.identifier_preparer
+        postgres = engine.dialect.name in ('postgres', 'postgresql')
+        inspector = Inspector.from_engine(engine)
+        existing = {}
+        created = []
+        for table, name, columns, method, where in _composite_indexes(
+                h_self._dict_table, h_self._pair_table, postgres):
+            if table.name not in existing:
+                existing[table.name] = set()
+                for ix in inspector.get_indexes(table.name):
+                    existing[table.name].add(ix['name'])
+                    existing[table.name].add(tuple(ix['column_names']))
+            if (name in existing[table.name] or
+                    tuple(c for c, s in columns) in existing[table.name]):
+                continue
+            ddl = 'CREATE INDEX %s%s ON %s %s(%s)' % (
+                online and postgres and 'CONCURRENTLY ' or '',
+                preparer.quote_identifier(name),
+                preparer.format_table(table),
+                method and 'USING %s ' % method or '',
+                ', '.join([preparer.quote_identifier(c) + (s and ' ' + s)
+                           for c, s in columns]))
+            if where and postgres:
+                ddl += ' WHERE ' + where
+            _create_index(engine, ddl, online, verbose)
+            created.append(name)
+        return created
+
+    def explain(h_self, statement):
+        """Return the query plan of `statement`, an sqlalchemy select or a
+        L{_Query}, as a list of lines."""
+        if isinstance(statement, h_self._Query):
+            statement = statement._query.with_labels().statement
+        dialect = h_self._engine.dialect
+        compiled = statement.compile(dialect=dialect)
+        params = compiled.construct_params()
+        if compiled.positional:
+            params = [params[n] for n in compiled.positiontup]
+        if dialect.name == 'sqlite':
+            explain_sql = 'EXPLAIN QUERY PLAN ' + str(compiled)
+        else:
+            explain_sql = 'EXPLAIN ' + str(compiled)
+        conn = h_self._engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(explain_sql, params)
+                # the plan is in the last column
+                return [str(row[-1]) for row in cursor.fetchall()]
+            finally:
+                cursor.close()
+        finally:
+            conn.close()
+
+    def _index_queries(h_self, session):
+        """Return the queries served by the composite indexes, as a list
+        of (description, statement) pairs, to compare their plans.
+
+        The key and value they look for are taken from the table.
+        """
+        t = h_self._dict_table
+        booking = (select([t.c.id], t.c.status == sql.START)
+                   .order_by(t.c.priority.desc(), t.c.id).limit(1))
+        if h_self.layout == 'document':
+            name, val = 'jobman.status', sql.START
+            for doc, in h_self._engine.execute(select([t.c.doc]).limit(1)):
+                for k, v in sorted((doc or {}).items()):
+                    if not k.startswith('jobman.') and not isinstance(v, dict):
+                        name, val = k, v
+                        break
+            return [('booking the next job', booking),
+                    ('filter_eq(%r, %r)' % (name, val),
+                     h_self.query(session).filter_eq(name, val))]
+
+        kv = h_self._pair_table
+        cols = [kv.c.dict_id, kv.c.name, kv.c.type, kv.c.ival, kv.c.fval,
+                kv.c.sval, kv.c.bval]
+        simple = kv.c.type.in_(['i', 'f', 's'])
+        user_key = ~kv.c.name.like('jobman.%')
+        if h_self._promoted:
+            # those do not use the keyval table
+            user_key = user_key & ~kv.c.name.in_(h_self._promoted.keys())
+        conn = h_self._engine.connect()
+        try:
+            sample = conn.execute(
+                select(cols, simple & user_key).limit(1)).first()
+            if sample is None:
+                sample = conn.execute(select(cols, simple).limit(1)).first()
+        finally:
+            conn.close()
+        if sample is None:
+            dict_id, name, val = 1, 'jobman.status', sql.START
+        else:
+            dict_id, name = sample[0], sample[1]
+            val = _decode_val(*sample[2:])
+
+        return [
+            ('booking the next job', booking),
+            ('keys of dictionary %d' % dict_id,
+             select(cols, (kv.c.dict_id == dict_id) & (kv.c.name == name))),
+            ('filter_eq(%r, %r)' % (name, val),
+             h_self.query(session).filter_eq(name, val)),
+        ]
+
+    def promote_key(h_self, key, type=None, verbose=False, force=False):
+        """Give `key` an indexed column of its own in the trial table, and
+        fill it from the key-value pairs.
+
+        Like the status, priority and hash columns, a promoted column is
+        written along with the key-value pair, and `_Query.filter_eq` and
+        `_Query.order_by` use it instead of the keyval table.  The
+        promoted keys of a table are stored in the database, so all the
+        handles opened afterwards use the column; this one and those
+        already open do not.
+
+        Promoting a key again only fills its column again, which catches
+        up with the dictionaries written by handles that did not know of
+        the column.  `_Query.filter_eq` and `_Query.order_by` fall back
+        to the key-value pairs where they left the column NULL, but not
+        where they changed the value of the key.  So that the workers do
+        not, the key is only promoted when no job is RUNNING, unless
+        `force` is set.
+
+        @type type: 'i', 'f' or 's'
+        @param type: the values stored in the column, as in the keyval
+        table; the values of other types are left out of it. By default,
+        the type of the values of `key` in the table.
+
+        @rtype: int
+        @return: the number of dictionaries with a value in the column
+
+        In the document layout, the key gets an expression index on its
+        value in the documents instead, used by `_Query.filter_eq` on
+        sqlite and by `_Query.order_by`; `type` is ignored.
+
+        @raise ValueError: if `type` is not given and cannot be guessed,
+        or if jobs are RUNNING and `force` is not set
+        """
+        if h_self.layout == 'document':
+            return h_self._index_doc_key(key, verbose)
+        kv = h_self._pair_table
+        engine = h_self._engine
+        running = engine.execute(
+            select([sqlalchemy.func.count(h_self._dict_table.c.id)],
+                   h_self._dict_table.c.status == sql.RUNNING)).scalar()
+        if running and not force:
+            raise ValueError('%i jobs are RUNNING, and their workers would'
+                             ' not write the column of key %r: promote it'
+                             ' when no job runs' % (running, key))
+        # The column is added on a copy of the table, as the table of this
+        # handle is already mapped.
+        t = h_self._dict_table.tometadata(MetaData())
+        if key in h_self._promoted:
+            colname, type = h_self._promoted[key]
+        else:
+            if type is None:
+                types = [r[0] for r in engine.execute(
+                    select([kv.c.type], kv.c.name == key, distinct=True))]
+                if len(types) != 1:
+                    raise ValueError('cannot guess the column type of key %r'
+                                     ' from the types %s of its values' %
+                                     (key, sorted(types)))
+                type = types[0]
+            if type not in ('i', 'f', 's'):
+                raise ValueError('promoted keys must hold integers (i),'
+                                 ' floats (f) or strings (s), not %r' % type)
+            colname = h_self._promoted_column_name(key)
+            t.append_column(_promoted_column(colname, type))
+            if verbose:
+                print 'Adding column %s to %s for key %s' % (colname, t.name,
+                                                           key)
+            _add_missing_columns(engine, t)
+            # the workers keep writing to the table
+            _create_missing_indexes(engine, [t], online=True, verbose=verbose)
+            engine.execute(h_self._promoted_table.insert(),
+                           name=key, type=type, colname=colname)
+
+        if verbose:
+            print 'Filling column %s from the values of %s' % (colname, key)
+        _fill_promoted(engine, t, kv, key, colname, type)
+        return engine.execute(
+            select([sqlalchemy.func.count(t.c.id)],
+                   t.c[colname] != None)).scalar()
+
+    def _index_doc_key(h_self, key, verbose=False):
+        """`promote_key` for the document layout."""
+        t = h_self._dict_table
+        engine = h_self._engine
+        preparer = engine.dialect.identifier_preparer
+        value = h_self._doc_value(key).compile(dialect=engine.dialect)
+        # the crc tells apart the keys that only differ by punctuation
+        name = 'ix_%s_doc_%s' % (t.name, ''.join(
+            [c if c.isalnum() else '_' for c in key.lower()]))
+        name = '%s_%08x' % (name[:54], zlib.crc32(key) & 0xffffffff)
+        _create_index(engine, 'CREATE INDEX IF NOT EXISTS %s ON %s ((%s))' % (
+            preparer.quote_identifier(name), preparer.format_table(t),
+            # no table name in index expressions
+            str(value).replace(preparer.format_table(t) + '.', '')),
+            verbose=verbose)
+        return engine.execute(
+            select([sqlalchemy.func.count(t.c.id)],
+                   h_self._doc_has(key))).scalar()
+
+    def _promoted_column_name(h_self, key):
+        """Return a trial table column name for the new promoted `key`."""
+        base = 'p_' + ''.join([c if c.isalnum() else '_'
+                               for c in key.lower()])[:50]
+        taken = set(c.name for c in h_self._dict_table.c)
+        taken.update(r[0] for r in h_self._engine.execute(
+            select([h_self._promoted_table.c.colname])))
+        colname = base
+        i = 1
+        while colname in taken:
+            i += 1
+            colname = '%s_%d' % (base, i)
+        return colname
+
+    def get_keys(h_self, ids, keys, default=None, chunk=500):
+        """Return an iterator over ``(id, v1, v2, ...)`` tuples, the values
+        of `keys` in the dictionaries `ids`.
+
+        Unlike `get`, only the requested key-value pairs are fetched, with
+        one query per `chunk` ids.  The tuples come in the order of `ids`;
+        ids that are not in the database are skipped and missing keys take
+        the value `default`.
+        """
+        if h_self.layout == 'document':
+            for row in h_self._get_doc_keys(ids, keys, default, chunk):
+                yield row
+            return
+        t = h_self._dict_table
+        kv = h_self._pair_table
+        keys = list(keys)
+        ids = list(ids)
+        index = dict((k, i) for i, k in enumerate(keys))
+        if keys:
+            on = (kv.c.dict_id == t.c.id) & kv.c.name.in_(keys)
+        else:
+            on = sqlalchemy.sql.false()
+        cols = [t.c.id, kv.c.name, kv.c.type, kv.c.ival, kv.c.fval,
+                kv.c.sval, kv.c.bval]
+        conn = h_self._engine.connect()
+        try:
+            for i in xrange(0, len(ids), chunk):
+                chunk_ids = ids[i:i + chunk]
+                q = select(cols, _in_ints(t.c.id, chunk_ids),
+                           from_obj=[t.outerjoin(kv, on)])
+                rows = {}
+                results = conn.execute(q).fetchall()
+                vals = _decode_vals([r[2:] for r in results
+                                     if r[1] is not None])
+                vals.reverse()
+                for r in results:
+                    row = rows.setdefault(r[0], [default] * len(keys))
+                    if r[1] is not None:
+                        row[index[r[1]]] = vals.pop()
+                for id in chunk_ids:
+                    if id in rows:
+                        yield (id,) + tuple(rows[id])
+        finally:
+            conn.close()
+
+    def _get_doc_keys(h_self, ids, keys, default, chunk):
+        """`get_keys` for the document layout."""
+        t = h_self._dict_table
+        ids = list(ids)
+        conn = h_self._engine.connect()
+        try:
+            for i in xrange(0, len(ids), chunk):
+                chunk_ids = ids[i:i + chunk]
+                docs = dict(conn.execute(select(
+                    [t.c.id, t.c.doc], _in_ints(t.c.id, chunk_ids))).fetchall())
+                trees = {}
+                for id in chunk_ids:
+                    if id not in docs:
+                        continue
+                    doc = docs[id] or {}
+                    row = [id]
+                    for key in keys:
+                        if key in doc:
+                            row.append(_decode_doc_val(doc[key], trees))
+                        else:
+                            row.append(default)
+                    yield tuple(row)
+        finally:
+            conn.close()
+
+    def connect_count(h_self):
+        """Return the number of connections made to the database, or None
+        if the engine was not made by `open_db`."""
+        counter = getattr(h_self, '_connect_counter', None)
+        if counter is None:
+            return None
+        return counter.count
+
+    def heartbeat(h_self, ids):
+        """Set the heartbeat of the RUNNING jobs `ids` to now.
+
+        See `sql.reap_stale`, which puts back to START the jobs whose
+        heartbeat is too old.
+        """
+        ids = list(ids)
+        if not ids:
+            return
+        conn = h_self._engine.connect()
+        try:
+            h_self._cached_conn(conn).execute(
+                h_self._statement('heartbeat'), [dict(b_id=i) for i in ids])
+        finally:
+            conn.close()
+
+    def status_counts(h_self):
+        """Return a dictionary mapping each jobman.status to its number of
+        jobs.
+
+        The counting is done by the database on the status column of the
+        trial table, no job is loaded.  Jobs without a status are counted
+        under None.
+        """
+        t = h_self._dict_table
+        q = select([t.c.status, sqlalchemy.func.count(t.c.id)],
+                   group_by=[t.c.status])
+        conn = h_self._engine.connect()
+        try:
+            return dict((status, count) for status, count in conn.execute(q))
+        finally:
+            conn.close()
+
     def session(h_self):
         return h_self._session_fn()
 
+    def enable_cache(h_self, maxsize=1000):
+        """Keep up to `maxsize` dictionaries loaded by `get` and
+        `_Query.all` in a process-local cache.
+
+        A cached dictionary is only returned if its `write` time in the
+        database did not change; this is checked with a query on the trial
+        table only.  The `write` time is maintained by this module, so
+        rows changed by older versions of jobman are not seen as changed.
+        `maxsize=0` disables the cache.
+        """
+        if maxsize:
+            h_self._cache = _LRUCache(maxsize)
+        else:
+            h_self._cache = None
+
+    def _cached_dicts(h_self, session, id_writes, chunk=500):
+        """Return the dictionaries of the (id, write) pairs `id_writes`, in
+        that order.
+
+        They come from the cache when their write time matches, and the
+        others are loaded, `chunk` at a time, detached and cached.
+        """
+        T = h_self._Dict
+        cache = h_self._cache
+        found = {}
+        to_load = []
+        for id, write in id_writes:
+            d = cache.get(id)
+            if d is not None and _cache_valid(d, write):
+                found[id] = d
+            else:
+                to_load.append(id)
+        for i in xrange(0, len(to_load), chunk):
+            q = (h_self.query(session)._query
+                 .filter(_in_ints(T.id, to_load[i:i + chunk])))
+            for d in q.all():
+                session.expunge(d)
+                cache.put(d.id, d)
+                found[d.id] = d
+        return [found[id] for id, write in id_writes if id in found]
+
     def get(h_self, id):
+        if h_self._cache is not None:
+            s = h_self.session()
+            try:
+                T = h_self._Dict
+                rval = h_self._cached_dicts(
+                    s, s.query(T.id, T.write).filter(T.id == id).all())
+            finally:
+                s.close()
+            if rval:
+                return rval[0]
+            return None
         s = h_self.session()
         rval = s.query(h_self._Dict).get(id)
         if rval:
@@ -712,7 +2579,10 @@ def db_from_engine(engine,
                    dbname,
                    table_prefix='DbHandle_default_',
                    trial_suffix='trial',
-                   keyval_suffix='keyval'):
+                   keyval_suffix='keyval',
+                   promoted_suffix='promoted',
+                   layout='keyval',
+                   doc_suffix='doc'):
     """Create a DbHandle instance
 
     @type engine: sqlalchemy engine (e.g. from create_engine)
@@ -722,52 +2592,396 @@ def db_from_engine(engine,
     @type trial_suffix: string
     @type keyval_suffix: string
 
+    @type layout: 'keyval' or 'document'
+
     @rtype: DbHandle instance
 
     @note: The returned DbHandle will use two tables to implement the
     many-to-many pattern that it needs:
      - I{table_prefix + trial_suffix},
      - I{table_prefix + keyval_suffix}
+    and lists the keys that have a column in the first one (see
+    L{DbHandle.promote_key}) in I{table_prefix + promoted_suffix}.
+
+    With the 'document' layout, it uses a single table instead,
+    I{table_prefix + doc_suffix}, with the columns of the first one and a
+    JSON document holding all the key-value pairs of each dictionary.
+    See L{migrate_layout} to copy a table to the other layout.
 
     """
     Session = sessionmaker(autoflush=True)  # , autocommit=False)
 
     metadata = MetaData()
 
-    t_trial = Table(table_prefix + trial_suffix, metadata,
-                    Column('id', Integer, primary_key=True),
-                    Column('create', DateTime),
-                    Column('write', DateTime),
-                    Column('read', DateTime),
-                    Column('status', Integer),
-                    Column('priority', Float(53)),
-                    Column('hash', BigInteger))
-
-    t_keyval = Table(table_prefix + keyval_suffix, metadata,
-                     Column('id', Integer, primary_key=True),
-                     Column('dict_id', Integer, index=True),
-                     # name of attribute
-                     Column('name', String(128), index=True, nullable=False),
-                     Column('type', String(1)),
-                     #Column('ntype', Boolean),
-                     Column('ival', BigInteger),
-                     Column('fval', Float(53)),
-                     Column('sval', Text),
-                     Column('bval', Binary),
-                     ForeignKeyConstraint(['dict_id'], [table_prefix + trial_suffix + '.id']))
+    def trial_columns():
+        return [Column('id', Integer, primary_key=True),
+                Column('create', DateTime),
+                Column('write', DateTime),
+                Column('read', DateTime),
+                Column('status', Integer, index=True),
+                Column('priority', Float(53)),
+                Column('hash', BigInteger, index=True),
+                # last sign of life of the worker running the job
+                Column('heartbeat', DateTime)]
+
+    if layout == 'document':
+        t_trial = Table(table_prefix + doc_suffix, metadata,
+                        *(trial_columns() + [Column('doc', _JSONDoc)]))
+        t_keyval = t_promoted = None
+    elif layout == 'keyval':
+        t_trial = Table(table_prefix + trial_suffix, metadata,
+                        *trial_columns())
+
+        t_keyval = Table(table_prefix + keyval_suffix, metadata,
+                         Column('id', Integer, primary_key=True),
+                         Column('dict_id', Integer, index=True),
+                         # name of attribute
+                         Column('name', String(128), index=True, nullable=False),
+                         Column('type', String(1)),
+                         #Column('ntype', Boolean),
+                         Column('ival', BigInteger),
+                         Column('fval', Float(53)),
+                         Column('sval', Text),
+                         Column('bval', Binary),
+                         ForeignKeyConstraint(['dict_id'], [table_prefix + trial_suffix + '.id']))
+
+        t_promoted = Table(table_prefix + promoted_suffix, metadata,
+                           Column('name', String(128), primary_key=True),
+                           # 'i', 'f' or 's', as in the keyval table
+                           Column('type', String(1), nullable=False),
+                           Column('colname', String(64), nullable=False))
+    else:
+        raise ValueError('unknown table layout', layout)
 
     #, ForeignKey('%s.id' % t_trial)),
     metadata.bind = engine
+    new_table = not engine.has_table(t_trial.name)
     metadata.create_all()  # no-op when tables already exist
+
+    promoted = {}
+    if t_promoted is not None:
+        for name, type, colname in engine.execute(
+                select([t_promoted.c.name, t_promoted.c.type,
+                        t_promoted.c.colname])):
+            promoted[name] = (colname, type)
+    for colname, type in sorted(promoted.values()):
+        t_trial.append_column(_promoted_column(colname, type))
+
     # warning: tables can exist, but have incorrect schema
     # see bug mentioned in DbHandle constructor
-
-    db = DbHandle(Session, engine, t_trial, t_keyval)
+    _add_missing_columns(engine, t_trial)
+
+    db = DbHandle(Session, engine, t_trial, t_keyval,
+                  promoted=promoted, promoted_table=t_promoted,
+                  layout=layout)
+    if new_table:
+        # existing tables get them from `jobman sqlindex`
+        db.create_composite_indexes(online=False)
     db.tablename = table_prefix
     db.dbname = dbname
     return db
 
 
+def migrate_layout(src, dst, chunk=1000, verbose=False):
+    """Copy the dictionaries of the DbHandle `src` into `dst`, a handle on
+    the same table in another layout, keeping their ids and the values of
+    the trial table columns.
+
+    The dictionaries already in `dst` are skipped, so the copy can be run
+    again to add the dictionaries inserted in `src` since.  Those changed
+    since in `src` are not copied again.
+
+    @rtype: int
+    @return: the number of dictionaries copied
+    """
+    t = dst._dict_table
+    trial_columns = ['id', 'create', 'write', 'read', 'status', 'priority',
+                     'hash', 'heartbeat']
+    n_copied = 0
+    s = src.session()
+    try:
+        for dicts in src.iter_chunks(src.query(s), chunk):
+            conn = dst._engine.connect()
+            try:
+                have = set(r[0] for r in conn.execute(select(
+                    [t.c.id], _in_ints(t.c.id, [d.id for d in dicts]))))
+            finally:
+                conn.close()
+            dicts = [d for d in dicts if d.id not in have]
+            if dicts:
+                dst._insert_chunk(
+                    [dict(d.items()) for d in dicts],
+                    [dict((c, getattr(d, c)) for c in trial_columns)
+                     for d in dicts])
+            n_copied += len(dicts)
+            if verbose and dicts:
+                print 'Copied %i dictionaries, up to id %i' % (n_copied,
+                                                               dicts[-1].id)
+    finally:
+        s.close()
+    if n_copied and dst._postgres():
+        # the ids were given, move the sequence past them
+        dst._engine.execute(sqlalchemy.sql.text(
+            "SELECT setval(pg_get_serial_sequence(:t, 'id'),"
+            " (SELECT max(id) FROM %s))" %
+            dst._engine.dialect.identifier_preparer.format_table(t)),
+            t=dst._engine.dialect.identifier_preparer.format_table(t))
+    return n_copied
+
+
+def snapshot_db(src, path, overlap=600, chunk=1000, verbose=False):
+    """Copy the table of the DbHandle `src` into the sqlite file `path`, or
+    bring up to date a copy made before.
+
+    The first call copies all the dictionaries.  The following ones only
+    copy those inserted since, or written (see the `write` column) up to
+    `overlap` seconds before the last change seen the previous time, to
+    allow for the clocks of the workers and their running transactions.
+    The dictionaries deleted from `src` are deleted from the copy.
+
+    The columns of the promoted keys are computed in the copy from the
+    copied key-value pairs, as those of `src` may lag behind them (see
+    `DbHandle.promote_key`); all of them are computed again when the
+    promoted keys of `src` changed.
+
+    Heartbeats alone do not change `write`: in the copy, they are as of
+    the last change of each dictionary.
+
+    Open the copy with ``open_db(dbstr, snapshot=path)``.
+
+    @rtype: (int, int)
+    @return: the number of dictionaries copied and deleted
+    """
+    engine = create_engine('sqlite:///' + os.path.abspath(path),
+                           poolclass=sqlalchemy.pool.NullPool)
+    if src._promoted_table is not None:
+        # for db_from_engine to add the promoted columns
+        promoted_table = src._promoted_table.tometadata(MetaData())
+        promoted_table.create(engine, checkfirst=True)
+        rows = [dict(row) for row in
+                src._engine.execute(select([src._promoted_table]))]
+        engine.execute(promoted_table.delete())
+        if rows:
+            engine.execute(promoted_table.insert(), rows)
+    dst = db_from_engine(engine, src.dbname, table_prefix=src.tablename,
+                         layout=src.layout)
+    marks = Table(src.tablename + 'snapshot', MetaData(),
+                  Column('write', DateTime),
+                  Column('id', Integer),
+                  Column('refreshed', DateTime),
+                  # the promoted keys of the last refresh
+                  Column('promoted', Text))
+    marks.create(engine, checkfirst=True)
+    _add_missing_columns(engine, marks)
+    promoted = repr(sorted(dst._promoted.items()))
+
+    def fill_promoted(conn, ids=None):
+        for key, (colname, type) in sorted(dst._promoted.items()):
+            _fill_promoted(conn, dt, dkv, key, colname, type, ids)
+
+    st, dt = src._dict_table, dst._dict_table
+    skv, dkv = src._pair_table, dst._pair_table
+    n_copied = n_deleted = 0
+    src_conn = src._engine.connect()
+    conn = engine.connect()
+    try:
+        # a consistent view of `src` on the serial engines of jobman
+        src_trans = src_conn.begin()
+        trans = conn.begin()
+        try:
+            last = conn.execute(select([marks.c.write, marks.c.id,
+                                        marks.c.promoted])).first()
+            changed = select([st.c.id]).order_by(st.c.id)
+            if last is not None:
+                write_mark, id_mark, last_promoted = last
+                new = st.c.id > (id_mark or 0)
+                if write_mark is not None:
+                    new = new | (st.c.write >= write_mark -
+                                 datetime.timedelta(seconds=overlap))
+                changed = changed.where(new)
+            else:
+                write_mark = id_mark = None
+            ids = [row[0] for row in src_conn.execute(changed)]
+
+            for i in xrange(0, len(ids), chunk):
+                chunk_ids = ids[i:i + chunk]
+                rows = [dict(row) for row in src_conn.execute(
+                    select([st], _in_ints(st.c.id, chunk_ids)))]
+                conn.execute(dt.delete().where(_in_ints(dt.c.id, chunk_ids)))
+                dst._executemany(conn, dt, rows)
+                if dkv is not None:
+                    conn.execute(dkv.delete().where(
+                        _in_ints(dkv.c.dict_id, chunk_ids)))
+                    dst._executemany(conn, dkv, [
+                        dict(row) for row in src_conn.execute(
+                            select([c for c in skv.c if c.name != 'id'],
+                                   _in_ints(skv.c.dict_id, chunk_ids)))])
+                    if last is None or last_promoted == promoted:
+                        fill_promoted(conn, chunk_ids)
+                for row in rows:
+                    if row['write'] is not None and (
+                            write_mark is None or row['write'] > write_mark):
+                        write_mark = row['write']
+                n_copied += len(rows)
+                if verbose:
+                    print 'Copied %i dictionaries' % n_copied
+            if ids:
+                id_mark = max(id_mark or 0, ids[-1])
+
+            gone = (set(row[0] for row in conn.execute(select([dt.c.id]))) -
+                    set(row[0] for row in src_conn.execute(select([st.c.id]))))
+            gone = sorted(gone)
+            for i in xrange(0, len(gone), chunk):
+                chunk_ids = gone[i:i + chunk]
+                conn.execute(dt.delete().where(_in_ints(dt.c.id, chunk_ids)))
+                if dkv is not None:
+                    conn.execute(dkv.delete().where(
+                        _in_ints(dkv.c.dict_id, chunk_ids)))
+            n_deleted = len(gone)
+            if last is not None and last_promoted != promoted:
+                fill_promoted(conn)
+
+            conn.execute(marks.delete())
+            conn.execute(marks.insert(), write=write_mark, id=id_mark,
+                         refreshed=datetime.datetime.now(),
+                         promoted=promoted)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        finally:
+            src_trans.rollback()
+    finally:
+        conn.close()
+        src_conn.close()
+    return n_copied, n_deleted
+
+
+def _create_missing_indexes(engine, tables, online=False, verbose=False):
+    """Create the indexes of `tables` that are missing in the database, and
+    return their names.
+
+    With `online` on postgres, they are built with CREATE INDEX
+    CONCURRENTLY, see `_create_index`.
+    """
+    inspector = Inspector.from_engine(engine)
+    created = []
+    for table in tables:
+        existing = set(tuple(ix['column_names'])
+                       for ix in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if tuple(c.name for c in index.columns) in existing:
+                continue
+            if verbose:
+                print 'Creating index %s on %s' % (index.name, table.name)
+            if online and engine.dialect.name in ('postgres', 'postgresql'):
+                ddl = str(CreateIndex(index).compile(dialect=engine.dialect))
+                ddl = ddl.replace('INDEX ', 'INDEX CONCURRENTLY ', 1)
+                _create_index(engine, ddl, online=True)
+            else:
+                index.create(engine)
+            created.append(index.name)
+    return created
+
+
+# Longest strings in the (name, sval) index on postgres, whose btree
+# entries must fit in a third of a page.
+_SVAL_INDEX_MAXLEN = 500
+
+
+def _composite_indexes(trial, keyval, postgres):
+    """Return the composite indexes of the `trial` and `keyval` tables, as
+    (table, index name, columns, method, condition) tuples.
+
+    The columns are (column name, suffix) pairs, the suffix being an
+    order or an operator class.  The method is None for the default
+    btree.  On postgres, an index with an SQL condition is partial: it
+    only holds the rows that match it, and the queries repeat the
+    condition to use it.  `keyval` is None in the document layout, whose
+    documents get a GIN index on postgres.
+    """
+    def name(table, *columns):
+        # postgres truncates longer names
+        return ('ix_%s_%s' % (table.name, '_'.join(columns)))[:63]
+
+    # booking: WHERE status = START ORDER BY priority DESC, id
+    rval = [(trial, name(trial, 'status', 'priority', 'id'),
+             [('status', ''), ('priority', 'DESC'), ('id', '')], None, None)]
+    if keyval is None:
+        if postgres:
+            # containment tests of _doc_eq
+            rval.append((trial, name(trial, 'doc'),
+                         [('doc', 'jsonb_path_ops')], 'gin', None))
+        return rval
+    return rval + [
+        # the keys of given dictionaries: get_keys, update_many, ...
+        (keyval, name(keyval, 'dict_id', 'name'),
+         [('dict_id', ''), ('name', '')], None, None),
+        # filter_eq
+        (keyval, name(keyval, 'name', 'ival'),
+         [('name', ''), ('ival', '')], None, "type = 'i'"),
+        (keyval, name(keyval, 'name', 'fval'),
+         [('name', ''), ('fval', '')], None, "type = 'f'"),
+        (keyval, name(keyval, 'name', 'sval'),
+         [('name', ''), ('sval', '')], None,
+         "type = 's' AND length(sval) < %d" % _SVAL_INDEX_MAXLEN),
+    ]
+
+
+def _create_index(engine, ddl, online=False, verbose=False):
+    """Execute the CREATE INDEX statement `ddl`, outside of a transaction
+    with `online` on postgres, as CREATE INDEX CONCURRENTLY needs."""
+    if verbose:
+        print ddl
+    if not (online and engine.dialect.name in ('postgres', 'postgresql')):
+        engine.execute(ddl)
+        return
+    conn = engine.raw_connection()
+    try:
+        old_level = conn.connection.isolation_level
+        conn.connection.set_isolation_level(0)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(ddl)
+            cursor.close()
+        finally:
+            conn.connection.set_isolation_level(old_level)
+    finally:
+        conn.close()
+
+
+def _add_missing_columns(engine, table):
+    """Add to the existing `table` the columns it lacks.
+
+    Tables made by older versions of jobman lack the columns added since.
+    Only nullable columns without default can be added this way.
+    """
+    preparer = engine.dialect.identifier_preparer
+
+    def column_names():
+        # cheaper than reflecting the table, and does not warn about types
+        result = engine.execute('SELECT * FROM %s WHERE 1 = 0' %
+                                preparer.format_table(table))
+        try:
+            return set(result.keys())
+        finally:
+            result.close()
+
+    existing = column_names()
+    for col in table.columns:
+        if col.name in existing:
+            continue
+        try:
+            engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                preparer.format_table(table),
+                preparer.format_column(col),
+                col.type.compile(dialect=engine.dialect)))
+        except sqlalchemy.exc.DBAPIError:
+            # another process added it in the meantime
+            if col.name not in column_names():
+                raise
+
+
 def get_password(hostname, dbname):
     """Return the current user's password for a given database
 
@@ -821,20 +3035,87 @@ port]/dbname?table=tablename
     return url
 
 
-def open_db(dbstr, echo=False, serial=False, poolclass=sqlalchemy.pool.NullPool, **kwargs):
+if sql.sqlalchemy_ok:
+    class _ConnectCounter(object):
+
+        """Count the new DBAPI connections made by a pool, as a listener
+        of its 'connect' event."""
+
+        def __init__(self):
+            self.count = 0
+
+        def connect(self, dbapi_con, con_record):
+            self.count += 1
+
+    def _pre_ping(dbapi_con, con_record, con_proxy):
+        """Test pooled connections when they are checked out, as a
+        listener of the 'checkout' event of the pool.
+
+        A connection that was closed by the server is replaced by a new
+        one instead of failing in the middle of a transaction.
+        """
+        try:
+            cursor = dbapi_con.cursor()
+            try:
+                cursor.execute('SELECT 1')
+            finally:
+                cursor.close()
+            # the DBAPI began a transaction for the SELECT: leave the
+            # connection as the pool handed it out
+            dbapi_con.rollback()
+        except Exception:
+            raise DisconnectionError()
+
+
+def open_db(dbstr, echo=False, serial=False, poolclass=sqlalchemy.pool.NullPool,
+            pooled=False, pool_size=2, max_overflow=3, pool_recycle=3600,
+            cache_size=0, snapshot=None, **kwargs):
     """Create an engine to access a DbHandle.
+
+    By default, every session makes a new connection to the database.
+    With `pooled`, connections are kept in a `QueuePool` of at most
+    `pool_size` + `max_overflow` connections, tested when they are checked
+    out, and replaced after `pool_recycle` seconds.  This is for long-lived
+    processes that access the database often, like `jobman sql` workers.
+
+    The number of connections made so far is returned by
+    `DbHandle.connect_count`.
+
+    With `cache_size`, the DbHandle keeps that many dictionaries in a
+    read cache, see `DbHandle.enable_cache`.
+
+    The table layout is chosen in the dbstring: ``?table=name`` uses the
+    key-value tables, ``?table=name&layout=document`` a table of JSON
+    documents, see `db_from_engine`.
+
+    With `snapshot`, the path of a copy of the table made by `snapshot_db`
+    (``jobman sqlsnapshot``), the DbHandle reads and writes that sqlite
+    file instead of the database of `dbstr`.
     """
     url = parse_dbstring(dbstr)
+    counter = _ConnectCounter()
+    engine_kwargs = dict(echo=echo)
+    if pooled:
+        poolclass = sqlalchemy.pool.QueuePool
+        engine_kwargs.update(pool_size=pool_size, max_overflow=max_overflow,
+                             pool_recycle=pool_recycle)
 
     tablename = url.query.pop('table')
+    layout = url.query.pop('layout', 'keyval')
     dbname = url.query.pop('dbname', None)
     if dbname == None:
         dbname = url.database
+    if snapshot is not None:
+        if not os.path.exists(snapshot):
+            raise ValueError('no snapshot file %s, see jobman sqlsnapshot'
+                             % snapshot)
+        url = make_url('sqlite:///' + os.path.abspath(snapshot))
 
     if serial:
         if sqlalchemy.__version__ >= '0.6':
             engine = create_engine(
-                url, echo=echo, poolclass=poolclass, isolation_level='SERIALIZABLE')
+                url, poolclass=poolclass, isolation_level='SERIALIZABLE',
+                **engine_kwargs)
         else:
             import psycopg2.extensions
 
@@ -845,11 +3126,18 @@ def open_db(dbstr, echo=False, serial=False, poolclass=sqlalchemy.pool.NullPool,
                 c.set_isolation_level(
                     psycopg2.extensions.ISOLATION_LEVEL_SERIALIZABLE)
                 return c
-            engine = create_engine('postgres://', creator=connect, poolclass=poolclass
-                                   )
+            engine = create_engine('postgres://', creator=connect, poolclass=poolclass,
+                                   **engine_kwargs)
 
     else:
-        engine = create_engine(url, echo=echo, poolclass=poolclass)
-
-    return db_from_engine(engine, table_prefix=tablename,
-                          dbname=dbname, **kwargs)
+        engine = create_engine(url, poolclass=poolclass, **engine_kwargs)
+    event.listen(engine, 'connect', counter.connect)
+    if pooled:
+        event.listen(engine, 'checkout', _pre_ping)
+
+    db = db_from_engine(engine, table_prefix=tablename,
+                        dbname=dbname, layout=layout, **kwargs)
+    db._connect_counter = counter
+    if cache_size:
+        db.enable_cache(cache_size)
+    return db
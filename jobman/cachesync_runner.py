@@ -192,10 +192,8 @@ def sync_single_directory(dir_path, all_jobs=None, force=False):
     if not all_jobs:
         conf = DD(parse.filemerge(os.path.join(dir_path, 'current.conf')))
     else:
-        conf = [i for i in all_jobs if str(
-            i.id) == os.path.split(dir_path)[-1]]
-        assert len(conf) == 1
-        conf = conf[0]
+        conf = all_jobs.get(os.path.split(dir_path)[-1])
+        assert conf is not None
 
     if 'jobman.status' not in conf\
        or 'jobman.sql.host_workdir' not in conf \
@@ -328,12 +326,20 @@ def cachesync_runner(options, dir):
     all_jobs = None
     if dbdesc:
         import api0
-        db = api0.open_db(dbdesc, serial=True)
+        db = api0.open_db(dbdesc, serial=True, snapshot=options.snapshot)
 
         try:
             session = db.session()
             q = db.query(session)
-            all_jobs = q.all()
+            # only the keys used by sync_single_directory, by job id
+            keys = ['jobman.status', 'jobman.sql.host_workdir',
+                    'jobman.sql.host_name']
+            missing = object()
+            all_jobs = {}
+            for row in q.select_keys(default=missing, *keys):
+                all_jobs[str(row[0])] = dict(
+                    [(k, v) for k, v in zip(keys, row[1:])
+                     if v is not missing])
         finally:
             try:
                 session.close()
@@ -358,6 +364,8 @@ cachesync_parser.add_option('-m', '--multiple', dest='multiple', default=False,
                             help='sync multiple jobs (in that case, "path_to_job" must be the directory that contains all the jobs, i.e. its subdirectories are 1, 2, 3...)')
 cachesync_parser.add_option('', '--sql', dest='sql', default="", action='store',
                             help='The db to witch we want to sync with.')
+cachesync_parser.add_option('', '--snapshot', dest='snapshot', default=None, action='store',
+                            help='read the jobs of --sql from this copy of the table, made by jobman sqlsnapshot.')
 
 runner_registry['cachesync'] = (cachesync_parser, cachesync_runner)
 
@@ -111,6 +111,8 @@ class SingleChannel(Channel):
         self.state = state
         self.feedback = None
         self.finish_up_notified = False
+        # set when we were asked to stop by a signal
+        self.stop_requested = False
 
         # TODO: make this a property and disallow changing it during a with
         # block
@@ -133,9 +135,29 @@ class SingleChannel(Channel):
             self.save_interval = int(save_interval)
         else:
             self.save_interval = None
+        # seconds between two calls to heartbeat(), None for never
+        self.heartbeat_interval = None
+        self.last_heartbeat_time = 0
+
+    def heartbeat(self):
+        """Tell the outside world that the job is still alive.
+
+        Called from `switch` at most every `heartbeat_interval` seconds.
+        """
+        pass
+
+    def maybe_heartbeat(self, now=None):
+        if self.heartbeat_interval is None:
+            return
+        if now is None:
+            now = time.time()
+        if now - self.last_heartbeat_time > self.heartbeat_interval:
+            self.last_heartbeat_time = now
+            self.heartbeat()
 
     def switch(self, message=None):
         now = time.time()
+        self.maybe_heartbeat(now)
         if self.feedback is None and not self.finish_up_notified:
             if self.finish_up_after is not None and\
                     now - self.start_time > self.finish_up_after:
@@ -195,6 +217,7 @@ class SingleChannel(Channel):
         # SIGTERM handler. It is the experiment function's responsibility to
         # call switch() often enough to get this feedback.
         self.feedback = 'stop'
+        self.stop_requested = True
 
     def __enter__(self):
         # install a SIGTERM handler that asks the experiment function to return
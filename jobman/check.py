@@ -1,6 +1,8 @@
 from subprocess import Popen, PIPE
 import os
+import Queue
 import re
+import threading
 import time
 from optparse import OptionParser
 
@@ -9,8 +11,35 @@ from runner import runner_registry
 from tools import UsageError
 from api0 import open_db
 
-parse_check = OptionParser(usage='%prog check <tablepath> ',
+parse_check = OptionParser(usage='%prog check [--snapshot=FILE] <tablepath> ',
                            add_help_option=False)
+parse_check.add_option('--snapshot', action="store", dest="snapshot",
+                       default=None,
+                       help='check the jobs of this copy of the table, made by jobman sqlsnapshot, instead of the database.')
+
+
+# The keys of the running jobs used by the checks
+_check_keys = ['jobman.experiment',
+               'jobman.sql.start_time',
+               'jobman.sql.host_name',
+               'jobman.sql.condor_slot',
+               'jobman.sql.condor_global_job_id',
+               'jobman.sql.condor_GlobalJobId',
+               'jobman.sql.sge_task_id',
+               'jobman.sql.job_id',
+               'jobman.sql.pbs_task_id']
+
+_missing = object()
+
+
+class _RunningJob(dict):
+
+    """The `_check_keys` of a job that are set, with the job id as `id`."""
+
+    def __init__(self, row):
+        dict.__init__(self, [(k, v) for k, v in zip(_check_keys, row[1:])
+                             if v is not _missing])
+        self.id = row[0]
 
 
 def str_time(run_time):
@@ -21,39 +50,171 @@ def str_time(run_time):
     return run_time
 
 
-def check_running_pbs_jobs(r, now):
-    """ Verify jobs on Torque/PBS system"""
-    p = Popen('qstat -x %s' % r['jobman.sql.pbs_task_id'],
-              shell=True, stdout=PIPE, stderr=PIPE)
-    ret = p.wait()
-    out = p.stdout.read()
+def _run_cmd(cmd):
+    """Run the shell command `cmd` and return (return code, stdout)."""
+    p = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
+    out, err = p.communicate()
+    return p.returncode, out
+
+
+def query_pbs_jobs():
+    """Return a dict pbs job id -> (state, walltime string) from a single
+    `qstat -x` call.
+
+    Each job is also reachable from the numeric part of its id, as the
+    server part is not always stored in the db.
+    """
+    ret, out = _run_cmd('qstat -x')
+    states = {}
+    for job in re.findall('<Job>.*?</Job>', out, re.S):
+        job_id = re.search('<Job_Id>(.*?)</Job_Id>', job)
+        state = re.search('<job_state>(.*?)</job_state>', job)
+        if job_id is None or state is None:
+            continue
+        #<walltime>48:00:00</walltime>
+        walltime = re.search('<Resource_List>.*?<walltime>(.*?)</walltime>',
+                             job, re.S)
+        if walltime is not None:
+            walltime = walltime.group(1)
+        info = (state.group(1), walltime)
+        states[job_id.group(1)] = info
+        states.setdefault(job_id.group(1).split('.')[0], info)
+    return states
+
+
+def query_sge_jobs():
+    """Return a dict (job id, task id) -> state from a single `qstat`
+    call, or None if qstat list no job.
+    """
+    ret, out = _run_cmd('qstat')
+    lines = out.splitlines(True)
+    """
+                qstat output:
+
+                job-ID  prior   name       user         state submit/start at     queue                          slots ja-task-ID
+                -----------------------------------------------------------------------------------------------------------------
+                 776410 0.50000 dbi_6a5f45 bastienf     r     10/18/2010 13:26:46 smp@r106-n72                       1 1
+                  776410 0.50000 dbi_6a5f45 bastienf     r     10/18/2010 13:26:46 smp@r106-n72                       1 2
+                   776415 0.00000 dbi_5381a1 bastienf     qw    10/18/2010 13:30:21                                    1 1,2
+    """
+    if len(lines) == 0:
+        return None
+
+    assert lines[
+        0] == 'job-ID  prior   name       user         state submit/start at     queue                          slots ja-task-ID \n'
+    assert lines[
+        1] == '-----------------------------------------------------------------------------------------------------------------\n'
+    states = {}
+    for line in lines[2:]:
+        sp = line.split()
+        # waiting jobs don't have a queue
+        if len(sp) not in (9, 10):
+            print "W: Don't understant one line of qstat output's. Can't tell reliably if its jobs are still running or not"
+            print "qstat output: ", line
+            continue
+        for task_id in sp[-1].split(','):
+            states[(sp[0], task_id)] = sp[4]
+    return states
+
+
+def query_condor_jobs(submit_host):
+    """Return a dict GlobalJobId -> JobStatus of all the jobs of
+    `submit_host` from a single `condor_q` call, or None if condor_q
+    failed.
+    """
+    cmd = ("condor_q -name %s -format '%%s ' GlobalJobId"
+           " -format '%%s\\n' JobStatus" % submit_host)
+    ret, out = _run_cmd(cmd)
+    if ret == 127 and len(out) == 0:
+        return None
+    states = {}
+    for line in out.splitlines():
+        sp = line.split()
+        if len(sp) == 2:
+            states[sp[0]] = sp[1]
+        elif sp:
+            print "W: condor return a not understood answer to a query. test command `%s`. stdout returned `%s`" % (cmd, line)
+    return states
+
+
+def query_condor_slots():
+    """Return a dict slot name -> [name, state, activity, remote user,
+    remote owner] for all the condor slots from a single `condor_status`
+    call. The remote user and owner are missing on unclaimed slots.
+    """
+    # The name is printed last as it is always defined, so each slot
+    # always end with a new line.
+    ret, out = _run_cmd('''condor_status -format "%s " State -format "%s " Activity -format "%s " RemoteUser -format "%s " RemoteOwner -format "%s\\n" Name''')
+    # return when running: Claimed Busy bastienf bastienf slot1@brams0b.iro.umontreal.ca
+    slots = {}
+    for line in out.splitlines():
+        sp = line.split()
+        if sp:
+            slots[sp[-1]] = sp[-1:] + sp[:-1]
+    return slots
+
 
-    if len(out) == 0:
+def query_parallel(queries, max_threads=8):
+    """Run the `queries`, a dict key -> (function, args), from a pool of
+    at most `max_threads` threads.
+
+    :returns: a dict key -> result. A query that raised is reported and
+              its result is None.
+    """
+    results = {}
+    todo = Queue.Queue()
+    for item in queries.items():
+        todo.put(item)
+
+    def worker():
+        while True:
+            try:
+                key, (f, args) = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[key] = f(*args)
+            except Exception, e:
+                print "W: the query %s failed: %s" % (key, e)
+                results[key] = None
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(max_threads, len(queries)))]
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def check_running_pbs_jobs(r, now, pbs_states):
+    """ Verify jobs on Torque/PBS system
+
+    :param pbs_states: the map returned by `query_pbs_jobs`.
+    """
+    info = pbs_states.get(str(r['jobman.sql.pbs_task_id']))
+    if info is None:
         print ("E: Job %d marked as PBS job '%s',"
                " but 'qstat' don't know it." % (
                    r.id, r['jobman.sql.pbs_task_id']))
         return
 
     run_time = str_time(now - r["jobman.sql.start_time"])
+    state_str, walltime_str = info
 
     # check runtime
-    #<walltime>48:00:00</walltime>
-    ressource_str = re.search('<Resource_List>.*</Resource_List>',
-                              out).group(0)
-    walltime_str = re.search('<walltime>.*?</walltime>', ressource_str)
-    walltime_str = walltime_str.group(0)[10:-11]
-    assert walltime_str[2] == ':' and walltime_str[5] == ':'
-    walltime = (int(walltime_str[:2]) * 60 * 60 +
-                int(walltime_str[3:5]) * 60 +
-                int(walltime_str[-2:]))
-    if now - int(r["jobman.sql.start_time"]) > walltime:
-        print ("W: Job %d is running for more then the specified"
-               " max time of %s. Run time %s" % (
-                   r.id, walltime_str, run_time))
+    if walltime_str is not None:
+        assert walltime_str[-3] == ':' and walltime_str[-6] == ':'
+        walltime = (int(walltime_str[:-6]) * 60 * 60 +
+                    int(walltime_str[-5:-3]) * 60 +
+                    int(walltime_str[-2:]))
+        if now - int(r["jobman.sql.start_time"]) > walltime:
+            print ("W: Job %d is running for more then the specified"
+                   " max time of %s. Run time %s" % (
+                       r.id, walltime_str, run_time))
 
     # check state
-    #<job_state>R</job_state>
-    state_str = re.search('<job_state>.*</job_state>', out).group(0)[11:-12]
     if state_str == "R":
         pass
     elif state_str == "Q":
@@ -69,57 +230,45 @@ def check_running_pbs_jobs(r, now):
                " state in the queue '%s'" % (r.id, state_str))
 
 
-def check_running_sge_jobs(r, now):
-    p = Popen('qstat', shell=True, stdout=PIPE)
-    ret = p.wait()
-    lines = p.stdout.readlines()
-    """
-                qstat output:
+def check_running_sge_jobs(r, now, sge_states):
+    """ Verify jobs on SGE system
 
-                job-ID  prior   name       user         state submit/start at     queue                          slots ja-task-ID
-                -----------------------------------------------------------------------------------------------------------------
-                 776410 0.50000 dbi_6a5f45 bastienf     r     10/18/2010 13:26:46 smp@r106-n72                       1 1
-                  776410 0.50000 dbi_6a5f45 bastienf     r     10/18/2010 13:26:46 smp@r106-n72                       1 2
-                   776415 0.00000 dbi_5381a1 bastienf     qw    10/18/2010 13:30:21                                    1 1,2
+    :param sge_states: the map returned by `query_sge_jobs`.
     """
-    if len(lines) == 0:
+    if sge_states is None:
         print "E: Job %d marked as a SGE job, but `qstat` on this host tell that their is no job running." % r.id
         return
 
-    assert lines[
-        0] == 'job-ID  prior   name       user         state submit/start at     queue                          slots ja-task-ID \n'
-    assert lines[
-        1] == '-----------------------------------------------------------------------------------------------------------------\n'
     run_time = str_time(now - r["jobman.sql.start_time"])
     if now - int(r["jobman.sql.start_time"]) > (24 * 60 * 60):
         print "W: Job %d is running for more then 24h. The current colosse max run time is 24h. Run time %s" % (r.id, run_time)
 
-    found = False
-    for line in lines[2:]:
-        sp = line.split()
-        ta_sp = sp[9].split(',')
-        if len(sp) != 10:
-            print "W: Job %d. Don't understant one line of qstat output's. Can't tell reliably if it is still running or not" % r.id
-            print "qstat output: ", line
-        if (sp[0] == r["jobman.sql.job_id"] and
-                r["jobman.sql.sge_task_id"] in ta_sp):
-            if sp[4] == 'r':
-                pass
-            elif sp[4] == 'qw':
-                print "E: Job %d is running in the db on sge with job id %s and task id %s, but it is waiting in the sge queue. Run time %s" % (
-                    r.id, r["jobman.sql.job_id"],
-                    r["jobman.sql.sge_task_id"], run_time)
-            elif sp[4] == 't':
-                print "W: Job %d is running in the db, but it is marked as ended in the sge queue. This can be synchonization issue. Retry in 1 minutes. Run time %s." % (
-                    r.id, run_time)
-            else:
-                print "W: Job %d is running in the db and in the sge queue, but we don't understant the state it is in the queue:", sp[4]
-                found = True  # in the sge queue
-                break
-    if not found:
+    state = sge_states.get((str(r["jobman.sql.job_id"]),
+                            str(r["jobman.sql.sge_task_id"])))
+    if state is None:
         print "E: Job %d marked as running in the db on sge with job id %s and task id %s, but not in sge queue. Run time %s." % (
             r.id, r["jobman.sql.job_id"],
             r["jobman.sql.sge_task_id"], run_time)
+    elif state == 'r':
+        pass
+    elif state == 'qw':
+        print "E: Job %d is running in the db on sge with job id %s and task id %s, but it is waiting in the sge queue. Run time %s" % (
+            r.id, r["jobman.sql.job_id"],
+            r["jobman.sql.sge_task_id"], run_time)
+    elif state == 't':
+        print "W: Job %d is running in the db, but it is marked as ended in the sge queue. This can be synchonization issue. Retry in 1 minutes. Run time %s." % (
+            r.id, run_time)
+    else:
+        print "W: Job %d is running in the db and in the sge queue, but we don't understant the state it is in the queue: %s" % (r.id, state)
+
+
+def _condor_gjid(r):
+    """Return the condor GlobalJobId of the running job `r` or None."""
+    if "jobman.sql.condor_global_job_id" in r:
+        return r["jobman.sql.condor_global_job_id"]
+    if "jobman.sql.condor_GlobalJobId" in r:
+        return r["jobman.sql.condor_GlobalJobId"]
+    return None
 
 
 def check_serve(options, dbdescr):
@@ -131,47 +280,72 @@ def check_serve(options, dbdescr):
     Example usage:
 
         jobman check <tablepath>
+        jobman check --snapshot local.sqlite <tablepath>
 
     """
-
-    db = open_db(dbdescr, serial=True)
+    snapshot = getattr(options, 'snapshot', None)
+    if snapshot is not None and not os.path.exists(snapshot):
+        raise UsageError('No snapshot file %s, make it with jobman'
+                         ' sqlsnapshot' % snapshot)
+    db = open_db(dbdescr, serial=True, snapshot=snapshot)
 
     try:
         session = db.session()
         q = db.query(session)
-        idle = q.filter_eq('jobman.status', 0).all()
-        running = q.filter_eq('jobman.status', 1).all()
-        finished = q.filter_eq('jobman.status', 2).all()
-        err_start = q.filter_eq('jobman.status', 3).all()
-        err_sync = q.filter_eq('jobman.status', 4).all()
-        err_run = q.filter_eq('jobman.status', 5).all()
-        canceled = q.filter_eq('jobman.status', -1).all()
+        counts = db.status_counts()
+        # Only the keys needed to check the running jobs are loaded, the
+        # other jobs are only counted
+        running = [_RunningJob(row) for row in
+                   q.filter_status(sql.RUNNING).select_keys(
+                       default=_missing, *_check_keys)]
         info = []
 
         print ("I: number of job by status (%d:START, %d:RUNNING, %d:DONE,"
                " %d:ERR_START, %d:ERR_SYNC, %d:ERR_RUN, %d:CANCELED)"
-               " in the db (%d:TOTAL)" % (len(idle), len(running),
-                                          len(finished), len(err_start),
-                                          len(err_sync), len(err_run),
-                                          len(canceled), len(q.all())))
+               " in the db (%d:TOTAL)" % (counts.get(sql.START, 0),
+                                          counts.get(sql.RUNNING, 0),
+                                          counts.get(sql.DONE, 0),
+                                          counts.get(sql.ERR_START, 0),
+                                          counts.get(sql.ERR_SYNC, 0),
+                                          counts.get(sql.ERR_RUN, 0),
+                                          counts.get(sql.CANCELED, 0),
+                                          sum(counts.values())))
         print
 
         # warn about job in error status
-        if len(err_start):
+        if counts.get(sql.ERR_START):
             print "E: The following jobs had an error when starting them",
-            print [j.id for j in err_start]
-        if len(err_sync):
+            print q.filter_status(sql.ERR_START).ids()
+        if counts.get(sql.ERR_SYNC):
             print "E: The following jobs had an error while doing the rsync",
-            print [j.id for j in err_sync]
-        if len(err_run):
+            print q.filter_status(sql.ERR_SYNC).ids()
+        if counts.get(sql.ERR_RUN):
             print "E: The following jobs had an error while running",
-            print [j.id for j in err_run]
+            print q.filter_status(sql.ERR_RUN).ids()
         print
 
         # check not 2 jobs in same slot+host
         host_slot = {}
         now = time.time()
 
+        # Query each jobs scheduler only once (once per submit host for
+        # condor), in parallel, and check the jobs against the answers.
+        queries = {}
+        for r in running:
+            if "jobman.sql.sge_task_id" in r:
+                queries['sge'] = (query_sge_jobs, ())
+            if "jobman.sql.pbs_task_id" in r:
+                queries['pbs'] = (query_pbs_jobs, ())
+            if r.get("jobman.sql.condor_slot",
+                     "no_condor_slot") != "no_condor_slot":
+                queries['condor_status'] = (query_condor_slots, ())
+                gjid = _condor_gjid(r)
+                if gjid is not None:
+                    submit_host = gjid.split('#')[0]
+                    queries['condor_q', submit_host] = (query_condor_jobs,
+                                                        (submit_host,))
+        answers = query_parallel(queries)
+
         # check job still running
         for idx, r in enumerate(running):
             condor_job = False
@@ -195,11 +369,11 @@ def check_serve(options, dbdescr):
 
             # check that the job is still running.
             if sge_job:
-                check_running_sge_jobs(r, now)
+                check_running_sge_jobs(r, now, answers['sge'])
                 continue
 
             if pbs_job:
-                check_running_pbs_jobs(r, now)
+                check_running_pbs_jobs(r, now, answers['pbs'] or {})
                 continue
 
             if not condor_job:
@@ -228,50 +402,35 @@ def check_serve(options, dbdescr):
             else:
                 host_slot[st] = idx
 
-            gjid = None
-            if "jobman.sql.condor_global_job_id" in r.keys():
-                gjid = r["jobman.sql.condor_global_job_id"]
-            elif "jobman.sql.condor_GlobalJobId" in r.keys():
-                gjid = r["jobman.sql.condor_GlobalJobId"]
+            gjid = _condor_gjid(r)
             if gjid is not None:
-                submit_host = gjid.split('#')[0]
-
-                #import pdb;pdb.set_trace()
-                # take care of the quotation, condor resquest that "" be used
-                # around string.
-                cmd = "condor_q -name %s -const 'GlobalJobId==\"%s\"' -format '%%s' 'JobStatus'" % (
-                    submit_host, gjid)
-                p = Popen(cmd, shell=True, stdout=PIPE)
-                ret = p.wait()
-                lines = p.stdout.readlines()
-
-                if ret == 127 and len(lines) == 0:
+                condor_states = answers['condor_q', gjid.split('#')[0]]
+                if condor_states is None:
                     print "W: Job %d. condor_q failed. Is condor installed on this computer?" % r.id
                     continue
 
-                if len(lines) == 0:
+                state = condor_states.get(gjid)
+                if state is None:
                     print "E: Job %d is marked as running in the bd on this condor jobs %s, but condor tell that this jobs is finished" % (r.id, gjid)
                     continue
-                elif len(lines) == 1:
-                    # condor unexpanded??? What should we do?
-                    if lines[0] == '0':
-                        print "E: Job %d is marked as running in the db, but its condor submited job is marked as unexpanded. We don't know what that mean, so we use an euristic to know if the jobs is still running." % r.id
-                    elif lines[0] == '1':  # condor idle
-                        print "E: Job %d is marked as running in the db, but its condor submited job is marked as idle. This can mean that the computer that was running this job crashed." % r.id
-                        continue
-                    elif lines[0] == '2':  # condor running
-                        continue
-                    elif lines[0] == '3':  # condor removed
-                        print "E: Job %d is marked as running in the db, but its condor submited job is marked as removed." % r.id
-                    elif lines[0] == '4':  # condor completed
-                        print "E: Job %d is marked as running in the db, but its condor submited job is marked as completed." % r.id
-                    elif lines[0] == '5':  # condor held
-                        print "E: Job %d is marked as running in the db, but its condor submited job is marked as held." % r.id
-                    elif lines[0] == '6':  # condor submission error
-                        print "E: Job %d is marked as running in the db, but its condor submited job is marked as submission error(SHOULD not happen as if condor can't start the job, it don't select one in the db)." % r.id
-
+                # condor unexpanded??? What should we do?
+                if state == '0':
+                    print "E: Job %d is marked as running in the db, but its condor submited job is marked as unexpanded. We don't know what that mean, so we use an euristic to know if the jobs is still running." % r.id
+                elif state == '1':  # condor idle
+                    print "E: Job %d is marked as running in the db, but its condor submited job is marked as idle. This can mean that the computer that was running this job crashed." % r.id
+                    continue
+                elif state == '2':  # condor running
+                    continue
+                elif state == '3':  # condor removed
+                    print "E: Job %d is marked as running in the db, but its condor submited job is marked as removed." % r.id
+                elif state == '4':  # condor completed
+                    print "E: Job %d is marked as running in the db, but its condor submited job is marked as completed." % r.id
+                elif state == '5':  # condor held
+                    print "E: Job %d is marked as running in the db, but its condor submited job is marked as held." % r.id
+                elif state == '6':  # condor submission error
+                    print "E: Job %d is marked as running in the db, but its condor submited job is marked as submission error(SHOULD not happen as if condor can't start the job, it don't select one in the db)." % r.id
                 else:
-                    print "W: condor return a not understood answer to a query. We will try some euristic to determine if it is running. test command `%s`. stdout returned `%s`" % (cmd, lines)
+                    print "W: condor return a not understood job status `%s` for job %d. We will try some euristic to determine if it is running." % (state, r.id)
     # except KeyError:
     #            pass
             info = (r.id,
@@ -284,25 +443,18 @@ def check_serve(options, dbdescr):
             if info[2] == "no_condor_slot":
                 print "W: Job %d is not running on condor(Should not happed...)" % info[0]
             else:
-                p = Popen('''condor_status -constraint 'Name == "slot%s@%s"' -format "%%s" Name -format " %%s" State -format " %%s" Activity -format " %%s" RemoteUser -format " %%s\n" RemoteOwner''' % (info[2], info[3]),
-                          shell=True, stdout=PIPE)
-                p.wait()
-                lines = p.stdout.readlines()
-                # return when running: slot1@brams0b.iro.umontreal.ca Claimed Busy bastienf bastienf
-                # return when don't exist: empty
-                if len(lines) == 0:
+                slot = "slot%s@%s" % (info[2], info[3])
+                sp = (answers['condor_status'] or {}).get(slot)
+                # sp when running: slot1@brams0b.iro.umontreal.ca Claimed Busy bastienf bastienf
+                # when don't exist: None
+                if sp is None:
                     print "W: Job %d is running on a host(%s) that condor lost connection with. The job run for: %s" % (r.id, info[3], run_time)
                     continue
-                elif len(lines) != 1 and not (len(lines) == 2 and lines[-1] == '\n'):
-                    print "W: Job %d condor_status return not understood: ", lines
-                    continue
-                sp = lines[0].split()
                 if len(sp) >= 3 and sp[1] in ["Unclaimed", "Owner"] and sp[2] == "Idle":
                     print "E: Job %d db tell that this job is running on %s. condor tell that this host don't run a job. running time %s" % (r.id, info[3], run_time)
                 elif len(sp) == 5:
-                    assert sp[0] == "slot%s@%s" % (info[2], info[3])
                     if sp[3] != sp[4]:
-                        print "W: Job %d condor_status return not understood: ", lines
+                        print "W: Job %d condor_status return not understood: " % r.id, sp
                     if sp[1] == "Claimed" and sp[2] in ["Busy", "Retiring"]:
                         if sp[4].split('@')[0] == os.getenv("USER"):
                             print "W: Job %d is running on a condor host that is running a job of the same user. running time: %s" % (r.id, run_time)
@@ -311,7 +463,7 @@ def check_serve(options, dbdescr):
                     else:
                         print "W: Job %d condor state of host not understood" % r.id, sp
                 else:
-                    print "W: Job %d condor_status return not understood: ", lines
+                    print "W: Job %d condor_status return not understood: " % r.id, sp
 
     finally:
         session.close()
@@ -0,0 +1,214 @@
+"""Export of the jobs of a table to columnar files, see `export_table`."""
+import os
+import csv
+import shutil
+import tempfile
+import zipfile
+
+_DTYPES = {'i': 'int64', 'f': 'float64', 's': 'int32'}
+
+
+class _Column(object):
+
+    """The values of a key, written to a raw file as they come.
+
+    Integers are stored as int64, with a boolean mask of the missing
+    values, floats as float64 with NaN for missing values, and strings
+    as int32 codes in a list of categories, -1 for missing values.
+    """
+
+    def __init__(self, tmpdir, name, type):
+        import numpy
+        self.numpy = numpy
+        self.name = name
+        self.type = type
+        self.dtype = numpy.dtype(_DTYPES[type])
+        self.path = os.path.join(tmpdir, '%i.raw' % id(self))
+        self.file = open(self.path, 'wb')
+        self.n_missing = 0
+        if type == 'i':
+            self.mask_path = self.path + '.mask'
+            self.mask_file = open(self.mask_path, 'wb')
+        elif type == 's':
+            self.codes = {}
+            self.categories = []
+
+    def append(self, values):
+        numpy = self.numpy
+        missing = [v is None for v in values]
+        self.n_missing += sum(missing)
+        if self.type == 'i':
+            numpy.array([v or 0 for v in values],
+                        dtype=self.dtype).tofile(self.file)
+            numpy.array(missing, dtype=bool).tofile(self.mask_file)
+        elif self.type == 'f':
+            numpy.array([numpy.nan if v is None else v for v in values],
+                        dtype=self.dtype).tofile(self.file)
+        else:
+            codes = []
+            for v in values:
+                if v is None:
+                    codes.append(-1)
+                    continue
+                code = self.codes.get(v)
+                if code is None:
+                    code = self.codes[v] = len(self.categories)
+                    self.categories.append(v)
+                codes.append(code)
+            numpy.array(codes, dtype=self.dtype).tofile(self.file)
+
+    def close(self):
+        self.file.close()
+        if self.type == 'i':
+            self.mask_file.close()
+
+    def arrays(self):
+        """Return the arrays of the column, as (file name, raw file or
+        array, dtype) triples."""
+        numpy = self.numpy
+        rval = [(self.name, self.path, self.dtype)]
+        if self.type == 'i' and self.n_missing:
+            rval.append((self.name + '.mask', self.mask_path,
+                         numpy.dtype(bool)))
+        elif self.type == 's':
+            categories = numpy.array(self.categories, dtype=unicode)
+            rval.append((self.name + '.categories', categories,
+                         categories.dtype))
+        return rval
+
+
+def _write_npy(path, n, source, dtype):
+    """Write the .npy file `path` of the `n` values of `dtype` in the raw
+    file `source`, or of the array `source`."""
+    import numpy
+    from numpy.lib import format
+    if not isinstance(source, basestring):
+        numpy.save(path, source)
+        return
+    f = open(path, 'wb')
+    try:
+        format.write_array_header_1_0(f, {'descr': format.dtype_to_descr(dtype),
+                                          'fortran_order': False,
+                                          'shape': (n,)})
+        raw = open(source, 'rb')
+        try:
+            shutil.copyfileobj(raw, f, 1 << 20)
+        finally:
+            raw.close()
+    finally:
+        f.close()
+
+
+def _file_names(columns):
+    """Return the name of the file of each (name, type) column: the key,
+    followed by the type if the key has values of several types."""
+    count = {}
+    for name, type in columns:
+        count[name] = count.get(name, 0) + 1
+    return [name if count[name] == 1 else '%s_%s' % (name, type)
+            for name, type in columns]
+
+
+def export_table(db, path, keys=None, chunk=10000, verbose=False):
+    """Write the keys of the jobs of `db` in columns, one row per job.
+
+    The format depends on `path`:
+     - I{name.csv}: a CSV file with a header line,
+     - I{name.npz}: a numpy archive, see `numpy.load`,
+     - otherwise, a directory of .npy files, which `numpy.load` can map
+       in memory (``mmap_mode='r'``).
+
+    The numpy formats have an `id` array, and an array per key: int64
+    and float64 for numbers, int32 codes in a `<key>.categories` array
+    for strings.  Missing values are NaN for floats, -1 for strings, and
+    are True in a `<key>.mask` array for integers.  A key with values of
+    several types has one array per type, suffixed by the type
+    character.  Keys holding other values (arrays, lists, ...) are left
+    out.
+
+    The key-value pairs are streamed and written `chunk` jobs at a time,
+    the memory used does not depend on the size of the table.
+
+    @type keys: list of strings, or None for all the keys
+    @return: the number of jobs written, and the names of the columns
+    """
+    session = db.session()
+    try:
+        columns = [(name, type) for name, type, colname, sa_type
+                   in db._view_columns(session, keys) if type != 'b']
+    finally:
+        session.close()
+    columns.sort()
+    names = _file_names(columns)
+
+    if path.endswith('.csv'):
+        n = _export_csv(db, path, columns, names, chunk, verbose)
+        return n, names
+
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        ids = _Column(tmpdir, 'id', 'i')
+        cols = [_Column(tmpdir, name, type)
+                for name, (key, type) in zip(names, columns)]
+        n = 0
+        for rows in db.iter_pivot(columns, chunk):
+            ids.append([row[0] for row in rows])
+            for i, col in enumerate(cols):
+                col.append([row[1][i] for row in rows])
+            n += len(rows)
+            if verbose:
+                print 'Exported %i jobs' % n
+        arrays = []
+        for col in [ids] + cols:
+            col.close()
+            arrays.extend(col.arrays())
+
+        if path.endswith('.npz'):
+            npy_dir = tmpdir
+        else:
+            npy_dir = path
+            if not os.path.isdir(npy_dir):
+                os.makedirs(npy_dir)
+        npy_files = []
+        for name, source, dtype in arrays:
+            npy_path = os.path.join(npy_dir, name + '.npy')
+            _write_npy(npy_path, n, source, dtype)
+            npy_files.append((name + '.npy', npy_path))
+        if path.endswith('.npz'):
+            # stored as is, as numpy.savez does
+            zf = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED,
+                                 allowZip64=True)
+            try:
+                for arcname, npy_path in npy_files:
+                    zf.write(npy_path, arcname)
+            finally:
+                zf.close()
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return n, names
+
+
+def _export_csv(db, path, columns, names, chunk, verbose):
+    def cell(v):
+        if v is None:
+            return ''
+        if isinstance(v, unicode):
+            return v.encode('utf-8')
+        if isinstance(v, float):
+            return repr(v)
+        return v
+
+    f = open(path, 'wb')
+    try:
+        writer = csv.writer(f)
+        writer.writerow(['id'] + names)
+        n = 0
+        for rows in db.iter_pivot(columns, chunk):
+            writer.writerows([[dict_id] + [cell(v) for v in values]
+                              for dict_id, values in rows])
+            n += len(rows)
+            if verbose:
+                print 'Exported %i jobs' % n
+    finally:
+        f.close()
+    return n
@@ -5,8 +5,8 @@ import logging
 
 from .tools import flatten
 from .api0 import open_db as sql_db, parse_dbstring
-from .sql import HOST, HOST_WORKDIR, EXPERIMENT, FUCKED_UP
-from .sql import insert_dict, hash_state
+from .sql import HOST, HOST_WORKDIR, EXPERIMENT
+from .sql import insert_dicts, known_jobs
 
 logging.basicConfig(level=logging.DEBUG, stream=sys.stderr)
 
@@ -63,7 +63,7 @@ def clear_db(db, **kwargs):
     class y (object):
         pass
     really_clear_db = False
-    n_records = len([i for i in db])
+    n_records = sum(db.status_counts().values())
     try:
         if y is input('Are you sure you want to DELETE ALL %i records from %s? (N/y)' %
                       (n_records, kwargs['dbstring'])):
@@ -90,11 +90,8 @@ def insert(db, dbstring, argv, job_fn, job_dct_seq, exp_root, **kwargs):
     didsomething = True
     pos = 0
     full_job_fn_name = job_fn.__module__ + '.' + job_fn.__name__
-    S = db.session()
-    for i, dct in enumerate(job_dct_seq):
-        # TODO: use hashlib, not the builtin hash function.  Requires changing in .sql as well, maybe more places?
-        # Also, will break old experiment code because inserts will all work
-        # even though jobs have already run.
+    states = []
+    for dct in job_dct_seq:
         state = dict(flatten(dct))
         if EXPERIMENT in state:
             if state[EXPERIMENT] != full_job_fn_name:
@@ -107,41 +104,29 @@ def insert(db, dbstring, argv, job_fn, job_dct_seq, exp_root, **kwargs):
             raise ValueError(('State dictionary has HOST/HOST_WORKDIR already set,'
                               ' use a lower-level insertion function if you really want to do this.'),
                              state)
+        states.append(state)
 
-        jobhash = hash_state(state)
-
-        if dryrun:
-            # TODO: detect if dct is a duplicate or not
-            if (None is S.query(db._Dict).filter(db._Dict.hash == jobhash).filter(db._Dict.status != FUCKED_UP).first()):
-                is_dup = False
-
-            else:
-                is_dup = True
-            # print 'DEBUG', inserted, jobhash
-        else:
-            if None is insert_dict(state, db, force_dup=False, priority=1, session=S):
-                is_dup = True
-            else:
-                is_dup = False
+    if dryrun:
+        is_dups = known_jobs(db, states, legacy_content=False)
+    else:
+        is_dups = [rval is None for rval in
+                   insert_dicts(states, db, force_dup=False, priority=1)]
 
+    for is_dup in is_dups:
         if is_dup:
             sys.stdout.write('-')
         else:
             pos += 1
             sys.stdout.write('.')
 
-        # print ' #', jobhash,':', experiment
-        # print '\n'
-
     sys.stdout.write('\n')
-    S.close()
     print '***************************************'
     if dryrun:
         print '*              Summary [DRY RUN]      *'
     else:
         print '*              Summary                *'
     print '***************************************'
-    print '* Inserted %i/%i jobs in database' % (pos, i + 1)
+    print '* Inserted %i/%i jobs in database' % (pos, len(states))
     print '***************************************'
 
     if '--dbi' in sys.argv:
@@ -160,9 +145,7 @@ def create_view(db, tablename, **kwargs):
 def status(db, **kwargs):
     """List counts of jobs that are queued, running, done, etc."""
     sts = {0: 0, 1: 0, 2: 0, 3: 0, 4: 0, 5: 0, 666: 0}
-    for d in db:
-        cnt = sts.get(d['jobman.status'], 0)
-        sts[d['jobman.status']] = cnt + 1
+    sts.update(db.status_counts())
 
     print 'QUEUED   :', sts[0]
     del sts[0]
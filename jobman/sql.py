@@ -10,11 +10,13 @@ except ImportError:
     import md5 as hashlib
 
 import random
+import struct
+import datetime
 
 sqlalchemy_ok = True
 try:
     import sqlalchemy
-    from sqlalchemy.orm import eagerload
+    from sqlalchemy.sql import select
     try:
         from sqlalchemy.orm.exc import StaleDataError as CONCURRENT_ERROR
     except ImportError:
@@ -75,7 +77,7 @@ def book_dct_postgres_serial(db, retry_max_sleep=10.0, verbose=1):
     dct = None
     while (dct is None) and keep_trying:
         # build a query
-        q = s.query(db._Dict)
+        q = db.query(s)._query
 
         # N.B.
         # use dedicated column to retrieve jobs, not the dictionary keyval pair
@@ -83,9 +85,6 @@ def book_dct_postgres_serial(db, retry_max_sleep=10.0, verbose=1):
         q = q.filter(db._Dict.status == START)
         q = q.order_by(db._Dict.priority.desc())
 
-        # this doesn't seem to work, hene the string hack below
-        q = q.options(eagerload('_attrs'))  # hard-coded in api0
-
         # try to reserve a dct
         try:
             # first() may raise psycopg2.ProgrammingError
@@ -131,11 +130,343 @@ def book_dct_postgres_serial(db, retry_max_sleep=10.0, verbose=1):
     return dct
 
 
-def book_dct_non_postgres(db):
-    print >> sys.stderr, """#TODO: use the priority field, not the status."""
-    print >> sys.stderr, """#TODO: ignore entries with key self.push_error."""
+def _load_booked_dcts(db, dict_ids, verbose):
+    if not dict_ids:
+        return []
+    s = db.session()
+    try:
+        dcts = db._load_dicts(s, dict_ids)
+    finally:
+        s.close()
+    if verbose:
+        for dct in dcts:
+            print 'book_unstarted_dct retrieved, ', dct
+    return dcts
+
+
+def _book_ids_postgres(db, k, retry_max_sleep, retries, verbose):
+    def build():
+        preparer = db._engine.dialect.identifier_preparer
+        return sqlalchemy.sql.text(
+            'UPDATE %(trial)s SET status = :running, %(write)s = :now,'
+            ' heartbeat = timezone(\'UTC\', now()) WHERE id IN ('
+            'SELECT id FROM %(trial)s WHERE status = :start'
+            ' ORDER BY priority DESC, id LIMIT :k FOR UPDATE SKIP LOCKED)'
+            ' RETURNING id' % dict(
+                trial=preparer.format_table(db._dict_table),
+                write=preparer.quote_identifier('write')))
+    book_sql = db._statement('book_postgres', build)
+
+    while True:
+        # SKIP LOCKED only makes sense when we see the rows committed by
+        # the other workers, whatever the engine isolation level.
+        conn = db._cached_conn(db._engine.connect()).execution_options(
+            isolation_level='READ COMMITTED')
+        try:
+            trans = conn.begin()
+            try:
+                ids = [row[0] for row in conn.execute(
+                    book_sql, running=RUNNING, start=START, k=k,
+                    now=datetime.datetime.now())]
+                if ids:
+                    db._set_status_key(conn, ids, RUNNING)
+                trans.commit()
+                return ids
+            except sqlalchemy.exc.DBAPIError, e:
+                trans.rollback()
+                retries -= 1
+                if retries <= 0:
+                    raise
+                if verbose:
+                    print 'caught exception', e
+                time.sleep(random.random() * retry_max_sleep)
+        finally:
+            conn.close()
+
+
+def _book_ids_sqlite(db, k, retry_max_sleep, retries, verbose):
+    t = db._dict_table
+    # the limit is compiled into the statement
+    pick = db._statement(('book_sqlite', k), lambda: (
+        select([t.c.id])
+        .where(t.c.status == START)
+        .order_by(t.c.priority.desc(), t.c.id)
+        .limit(k)))
+    # the heartbeat is taken from the database clock, see reap_stale
+    book = db._statement('book_sqlite_update', lambda: (
+        db._statement('trial_update').values(heartbeat=db._db_now())))
+
+    while True:
+        conn = db._cached_conn(db._engine.connect())
+        # Let us issue BEGIN ourselves instead of the sqlite3 module.
+        dbapi_conn = conn.connection.connection
+        old_isolation_level = dbapi_conn.isolation_level
+        dbapi_conn.isolation_level = None
+        try:
+            # The SqlAlchemy transaction only prevents autocommit, the real
+            # one is driven by the BEGIN IMMEDIATE / COMMIT statements.
+            trans = conn.begin()
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    ids = [row[0] for row in conn.execute(pick)]
+                    now = datetime.datetime.now()
+                    if ids:
+                        conn.execute(book, [dict(b_id=i, status=RUNNING,
+                                                 write=now) for i in ids])
+                        db._set_status_key(conn, ids, RUNNING)
+                    conn.execute('COMMIT')
+                except:
+                    conn.execute('ROLLBACK')
+                    raise
+                trans.commit()
+                return ids
+            except sqlalchemy.exc.DBAPIError, e:
+                # typically "database is locked"
+                trans.rollback()
+                retries -= 1
+                if retries <= 0:
+                    raise
+                if verbose:
+                    print 'caught exception', e
+                time.sleep(random.random() * retry_max_sleep)
+        finally:
+            dbapi_conn.isolation_level = old_isolation_level
+            conn.close()
+
+
+def book_dct_postgres_skip_locked(db, retry_max_sleep=1.0, retries=10,
+                                  verbose=1):
+    """Find a trial with status START and mark it RUNNING.
+
+    Same contract as `book_dct_postgres_serial`, but the highest-priority
+    START row is claimed by a single statement using
+    ``SELECT ... FOR UPDATE SKIP LOCKED``.  Concurrent workers skip the rows
+    that are being booked instead of failing to serialize, so there is
+    nothing to retry in the common case.
+
+    Requires postgres >= 9.5.
+    """
+    ids = _book_ids_postgres(db, 1, retry_max_sleep, retries, verbose)
+    dcts = _load_booked_dcts(db, ids, verbose)
+    if dcts:
+        return dcts[0]
+    return None
+
+
+def book_dct_non_postgres(db, retry_max_sleep=1.0, retries=10, verbose=1):
+    """Find a trial with status START and mark it RUNNING (sqlite version).
+
+    The whole select-and-update runs under ``BEGIN IMMEDIATE``, which takes
+    the database write lock up front, so two workers can never pick the same
+    trial.
+    """
+    if db._engine.dialect.name != 'sqlite':
+        raise NotImplementedError(
+            'no job booking for database', db._engine.dialect.name)
+    ids = _book_ids_sqlite(db, 1, retry_max_sleep, retries, verbose)
+    dcts = _load_booked_dcts(db, ids, verbose)
+    if dcts:
+        return dcts[0]
+    return None
+
+
+def _has_skip_locked(db):
+    dialect = db._engine.dialect
+    if dialect.server_version_info is None:
+        # server_version_info is only known after the first connection
+        db._engine.connect().close()
+    return dialect.server_version_info >= (9, 5)
+
+
+def book_dct(db, verbose=1):
+    """Find a trial with status START, mark it RUNNING and return it.
+
+    Returns None if no such trial exists in DB.
+
+    This picks the booking function matching the database engine: postgres
+    servers that support ``SKIP LOCKED`` use `book_dct_postgres_skip_locked`,
+    older ones fall back on `book_dct_postgres_serial`, and sqlite uses
+    `book_dct_non_postgres`.
+    """
+    if db._engine.dialect.name in ('postgres', 'postgresql'):
+        if _has_skip_locked(db):
+            return book_dct_postgres_skip_locked(db, verbose=verbose)
+        return book_dct_postgres_serial(db, verbose=verbose)
+    return book_dct_non_postgres(db, verbose=verbose)
+
 
-    raise NotImplementedError()
+def book_many(db, k, retry_max_sleep=1.0, retries=10, verbose=1):
+    """Find up to `k` trials with status START and mark them all RUNNING.
+
+    The trials are booked in a single transaction, and loaded back with a
+    single query.  They are returned highest priority first; the list is
+    empty if no trial is left.
+
+    The caller owns the returned trials: the ones it does not end up running
+    should be handed back with `release_dcts`.
+    """
+    dialect_name = db._engine.dialect.name
+    if dialect_name in ('postgres', 'postgresql'):
+        if not _has_skip_locked(db):
+            # no way to book atomically, book them one by one
+            rval = []
+            while len(rval) < k:
+                dct = book_dct_postgres_serial(db, verbose=verbose)
+                if dct is None:
+                    break
+                rval.append(dct)
+            return rval
+        ids = _book_ids_postgres(db, k, retry_max_sleep, retries, verbose)
+    elif dialect_name == 'sqlite':
+        ids = _book_ids_sqlite(db, k, retry_max_sleep, retries, verbose)
+    else:
+        raise NotImplementedError('no job booking for database', dialect_name)
+    return _load_booked_dcts(db, ids, verbose)
+
+
+def release_dcts(db, dcts):
+    """Put booked trials that were never started back in the START status.
+
+    Only the trials that are still RUNNING are changed, so a trial whose
+    status was changed by someone else in the meantime is left alone.
+
+    :returns: the ids of the released trials.
+    """
+    t = db._dict_table
+    ids = [dct.id for dct in dcts]
+    if not ids:
+        return []
+    conn = db._engine.connect()
+    try:
+        trans = conn.begin()
+        try:
+            running = [row[0] for row in conn.execute(
+                select([t.c.id])
+                .where(t.c.id.in_(ids) & (t.c.status == RUNNING)))]
+            if running:
+                conn.execute(t.update().where(t.c.id.in_(running))
+                             .values(status=START, heartbeat=None,
+                                     write=datetime.datetime.now()))
+                db._set_status_key(conn, running, START)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+    finally:
+        conn.close()
+    return running
+
+
+class PrefetchQueue(object):
+
+    """Local queue of jobs booked `k` at a time with `book_many`.
+
+    Each `pop` returns the next booked job, and refills the queue with a
+    single booking transaction when it is empty.  Jobs that are still in
+    the queue when the worker stops must be handed back with `release`.
+    """
+
+    def __init__(self, db, k, verbose=1):
+        self.db = db
+        self.k = k
+        self.verbose = verbose
+        self.queue = []
+
+    def __len__(self):
+        return len(self.queue)
+
+    def pop(self, limit=None):
+        """Return the next booked job, or None if no job is left.
+
+        :param limit: book at most that many jobs when refilling the queue.
+        """
+        if not self.queue:
+            k = self.k
+            if limit is not None:
+                k = max(1, min(k, limit))
+            self.queue = book_many(self.db, k, verbose=self.verbose)
+        if self.queue:
+            return self.queue.pop(0)
+        return None
+
+    def ids(self):
+        """Return the ids of the jobs in the queue."""
+        return [dct.id for dct in self.queue]
+
+    def release(self):
+        """Hand the jobs that were not started back to START."""
+        dcts, self.queue = self.queue, []
+        released = release_dcts(self.db, dcts)
+        if released and self.verbose:
+            print 'Released %i prefetched jobs: %s' % (len(released),
+                                                      released)
+        return released
+
+
+def reap_stale(db, stale, verbose=1, chunk=500):
+    """Put back to START the RUNNING jobs whose heartbeat is older than
+    `stale` seconds.
+
+    The heartbeat is set when a job is booked and refreshed by the worker
+    running it (see `DbHandle.heartbeat`), so these jobs were most likely
+    lost with their worker.  Jobs without heartbeat, started by older
+    versions of jobman, are left alone.
+
+    The heartbeats and the cutoff are both taken from the clock of the
+    database (see `DbHandle._db_now`), not from those of the workers and
+    of the caller.
+
+    :returns: the ids of the reaped jobs.
+    """
+    t = db._dict_table
+    now = datetime.datetime.now()
+    conn = db._engine.connect()
+    try:
+        trans = conn.begin()
+        try:
+            if db._engine.dialect.name in ('postgres', 'postgresql'):
+                # A single UPDATE that reports what it changed
+                preparer = db._engine.dialect.identifier_preparer
+                ids = [row[0] for row in conn.execute(sqlalchemy.sql.text(
+                    'UPDATE %(trial)s SET status = :start, %(write)s = :now,'
+                    ' heartbeat = NULL'
+                    ' WHERE status = :running AND heartbeat <'
+                    ' timezone(\'UTC\', now()) - :stale * interval \'1 second\''
+                    ' RETURNING id' % dict(
+                        trial=preparer.format_table(t),
+                        write=preparer.quote_identifier('write'))),
+                    start=START, running=RUNNING, now=now, stale=stale)]
+            else:
+                stale_jobs = ((t.c.status == RUNNING) &
+                              (t.c.heartbeat < db._db_cutoff(stale)))
+                candidates = [row[0] for row in
+                              conn.execute(select([t.c.id]).where(stale_jobs))]
+                # The transaction only takes the write lock with the first
+                # UPDATE: a worker may have refreshed or finished one of the
+                # candidates since the SELECT.  Keep the rows that were reset.
+                ids = []
+                for i in xrange(0, len(candidates), chunk):
+                    in_chunk = t.c.id.in_(candidates[i:i + chunk])
+                    conn.execute(t.update()
+                                 .where(in_chunk & stale_jobs)
+                                 .values(status=START, write=now,
+                                         heartbeat=None))
+                    ids.extend(row[0] for row in conn.execute(
+                        select([t.c.id]).where(in_chunk &
+                                               (t.c.status == START) &
+                                               (t.c.write == now))))
+            for i in xrange(0, len(ids), chunk):
+                db._set_status_key(conn, ids[i:i + chunk], START)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+    finally:
+        conn.close()
+    if ids and verbose:
+        print 'Reaped %i stale jobs: %s' % (len(ids), ids)
+    return ids
 
 
 def db(dbstr):
@@ -151,7 +482,78 @@ def db(dbstr):
 ###########
 
 
+def _canonical_item(key, val):
+    """Return a byte string that identifies the (key, val) pair.
+
+    Values are encoded the way they will read back from the database:
+    unicode and str are the same string, booleans are integers.  The
+    fields are length-prefixed so that no two pairs share an encoding.
+    """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    if isinstance(val, unicode):
+        val = val.encode('utf-8')
+    if isinstance(val, str):
+        enc = 's' + val
+    elif isinstance(val, (int, long)):
+        enc = 'i%d' % val
+    elif isinstance(val, float):
+        enc = 'f' + repr(val)
+    else:
+        enc = 'b' + repr(val)
+    return '%d:%s%d:%s' % (len(key), key, len(enc), enc)
+
+
+def _digest64(items):
+    items.sort()
+    digest = hashlib.sha224(''.join(items)).digest()
+    return struct.unpack('>q', digest[:8])[0]
+
+
 def hash_state(state):
+    """Return a 64-bit hash of the content of `state`.
+
+    The hash only depends on the keys and values of `state`, not on
+    Python's `hash()`, so it is the same on every host and Python build.
+    It fits the signed BigInteger `hash` column of the trial table.
+    """
+    return _digest64([_canonical_item(k, v) for k, v in state.iteritems()])
+
+
+def hash_states(states):
+    """Return `[hash_state(state) for state in states]`, faster.
+
+    The jobs of a sweep share most of their (key, value) pairs, so the
+    encoding of each pair is computed once for the whole batch.
+    """
+    memo = {}
+    rval = []
+    for state in states:
+        items = []
+        for k, v in state.iteritems():
+            if isinstance(v, float):
+                # 0.0 == -0.0, but they are encoded differently
+                memo_key = (k, type(v), repr(v))
+            else:
+                memo_key = (k, type(v), v)
+            try:
+                item = memo[memo_key]
+            except KeyError:
+                item = memo[memo_key] = _canonical_item(k, v)
+            except TypeError:
+                # unhashable value
+                item = _canonical_item(k, v)
+            items.append(item)
+        rval.append(_digest64(items))
+    return rval
+
+
+def hash_state_py(state):
+    """The `hash_state` of older versions, which depends on Python's hash().
+
+    Jobs inserted by these versions carry this hash, so the duplicate
+    checks also look for it.
+    """
     l = list((k, str(v)) for k, v in state.iteritems())
     l.sort()
     return hash(hashlib.sha224(repr(l)).hexdigest())
@@ -178,8 +580,11 @@ def insert_dict(jobdict, db, force_dup=False, session=None, priority=1.0, hashal
     else:
         s = session
 
+    hashes = [jobhash]
+    if hashalgo is hash_state:
+        hashes.append(hash_state_py(job))
     do_insert = force_dup or (None is s.query(db._Dict).filter(
-        db._Dict.hash == jobhash).filter(db._Dict.status != FUCKED_UP).first())
+        db._Dict.hash.in_(hashes)).filter(db._Dict.status != FUCKED_UP).first())
 
     rval = None
     if do_insert:
@@ -211,9 +616,143 @@ def insert_job(experiment_fn, state, db, force_dup=False, session=None, priority
     return insert_dict(state, db, force_dup=force_dup, session=session, priority=priority)
 
 
-# TODO: FIXME: WARNING
-# Should use insert_dict instead of db.insert.  Need one entry point for adding jobs to
-# database, so that hashing can be done consistently
+def known_hashes(db, hashes, chunk=2000):
+    """Return the subset of `hashes` that are already in the database.
+
+    Jobs with status FUCKED_UP do not count.  The lookup is done with one
+    ``hash IN (...)`` query per `chunk` hashes, on the indexed `hash`
+    column.
+    """
+    t = db._dict_table
+    hashes = list(set(hashes))
+    rval = set()
+    if not hashes:
+        return rval
+    conn = db._engine.connect()
+    try:
+        for i in xrange(0, len(hashes), chunk):
+            # The hashes are integers: inline them, binding thousands of
+            # parameters costs more than the query.
+            in_list = sqlalchemy.sql.literal_column(
+                '(%s)' % ','.join(['%d' % h for h in hashes[i:i + chunk]]))
+            q = select([t.c.hash]).where(
+                t.c.hash.op('IN')(in_list) & (t.c.status != FUCKED_UP))
+            rval.update(row[0] for row in conn.execute(q))
+    finally:
+        conn.close()
+    return rval
+
+
+def known_jobs(db, jobs, jobhashes=None, legacy_hash=True,
+               legacy_content=True, session=None):
+    """Return a list of flags telling which `jobs` are already in `db`.
+
+    The jobs are looked up by their `jobhashes` (`hash_states(jobs)` by
+    default) in batched queries on the indexed `hash` column.
+
+    :param legacy_hash: also look up the `hash_state_py` of the jobs, the
+                        hash used by older versions.
+    :param legacy_content: rows inserted without a hash (by older versions
+                           of `add_experiments_to_db`) can only be found by
+                           content.  If the table has some, look up the
+                           jobs not found by hash with `filter_eq_dct`.
+    """
+    if jobhashes is None:
+        jobhashes = hash_states(jobs)
+    lookup = list(jobhashes)
+    if legacy_hash:
+        legacy_hashes = [hash_state_py(job) for job in jobs]
+        lookup.extend(legacy_hashes)
+    known = known_hashes(db, lookup)
+    rval = [h in known for h in jobhashes]
+    if legacy_hash:
+        rval = [dup or h in known for dup, h in zip(rval, legacy_hashes)]
+
+    if legacy_content and False in rval:
+        t = db._dict_table
+        if session is None:
+            s = db.session()
+        else:
+            s = session
+        try:
+            if s.execute(select([t.c.id]).where(t.c.hash == None)
+                         .limit(1)).first() is not None:
+                for i, job in enumerate(jobs):
+                    if not rval[i]:
+                        rval[i] = (None is not
+                                   db.query(s).filter_eq_dct(job).first())
+        finally:
+            if session is None:
+                s.close()
+    return rval
+
+
+def insert_dicts(jobdicts, db, force_dup=False, priority=1.0, hashalgo=hash_state, chunk=1000):
+    """Insert many `job` dictionaries into database `db` at once.
+
+    This is the bulk version of `insert_dict`: duplicates are looked up with
+    one query per chunk of jobs, and the new jobs are inserted with
+    `DbHandle.insert_many`.
+
+    :returns: a list with, for each job, the id of the inserted job or None
+              if it was a duplicate.
+    """
+    rval = []
+    batch = []
+    for jobdict in jobdicts:
+        batch.append(jobdict)
+        if len(batch) >= chunk:
+            rval.extend(_insert_dicts_chunk(batch, db, force_dup, priority,
+                                            hashalgo, chunk))
+            batch = []
+    if batch:
+        rval.extend(_insert_dicts_chunk(batch, db, force_dup, priority,
+                                        hashalgo, chunk))
+    return rval
+
+
+def _insert_dicts_chunk(jobdicts, db, force_dup, priority, hashalgo, chunk):
+    jobs = [copy.copy(jobdict) for jobdict in jobdicts]
+    if hashalgo is hash_state:
+        jobhashes = hash_states(jobs)
+    else:
+        jobhashes = [hashalgo(job) for job in jobs]
+
+    known = set()
+    is_known = [False] * len(jobs)
+    if not force_dup:
+        is_known = known_jobs(db, jobs, jobhashes,
+                               legacy_hash=hashalgo is hash_state,
+                               legacy_content=False)
+
+    to_insert = []
+    inserted = []
+    for jobhash, job, dup in zip(jobhashes, jobs, is_known):
+        if dup or jobhash in known:
+            inserted.append(False)
+            continue
+        if not force_dup:
+            # identical jobs within the chunk
+            known.add(jobhash)
+        if STATUS not in job:
+            job[STATUS] = START
+        if HASH not in job:
+            job[HASH] = jobhash
+        if PRIORITY not in job:
+            job[PRIORITY] = priority
+        to_insert.append(job)
+        inserted.append(True)
+
+    ids = iter(db.insert_many(to_insert, chunk=chunk))
+    rval = []
+    for flag in inserted:
+        if flag:
+            rval.append(ids.next())
+        else:
+            rval.append(None)
+    return rval
+
+
 def add_experiments_to_db(jobs, db, verbose=0, force_dup=False, type_check=None, session=None):
     """Add experiments paramatrized by jobs[i] to database db.
 
@@ -233,18 +772,28 @@ def add_experiments_to_db(jobs, db, verbose=0, force_dup=False, type_check=None,
     :returns: list of (Bool,job[i]) in which the flags mean the corresponding job actually was
     inserted.
 
+    :param session: if given, the duplicates are looked up and the new
+    jobs inserted in its transaction; the caller must commit it.
+
+    :note: Duplicates are found by `hash_state`, which is stored in the
+    HASH key like `insert_dict` does.  The new jobs are inserted together
+    with `DbHandle.insert_many` once all of them have been checked.
+
     """
     rval = []
-    for job in jobs:
-        job = copy.copy(job)
-        if session is None:
-            s = db.session()
-            do_insert = force_dup or (
-                None is db.query(s).filter_eq_dct(job).first())
-            s.close()
-        else:
-            do_insert = force_dup or (
-                None is db.query(session).filter_eq_dct(job).first())
+    to_insert = []
+    jobs = [copy.copy(job) for job in jobs]
+    jobhashes = hash_states(jobs)
+    if force_dup:
+        is_known = [False] * len(jobs)
+    else:
+        is_known = known_jobs(db, jobs, jobhashes, session=session)
+    pending = set()
+    for job, jobhash, dup in zip(jobs, jobhashes, is_known):
+        do_insert = force_dup or not (dup or jobhash in pending)
+        if not force_dup:
+            # an identical job may be waiting to be inserted
+            pending.add(jobhash)
 
         if do_insert:
             if type_check:
@@ -255,14 +804,17 @@ def add_experiments_to_db(jobs, db, verbose=0, force_dup=False, type_check=None,
 
             job[STATUS] = START
             job[PRIORITY] = 1.0
+            if HASH not in job:
+                job[HASH] = jobhash
             if verbose:
                 print 'ADDING  ', job
-            db.insert(job)
+            to_insert.append(job)
             rval.append((True, job))
         else:
             if verbose:
                 print 'SKIPPING', job
             rval.append((False, job))
+    db.insert_many(to_insert, session=session)
     return rval
 
 